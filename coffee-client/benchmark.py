@@ -0,0 +1,159 @@
+"""Benchmark of complete channel lifecycles against local fake Flash servers and a fake MQTT broker.
+
+Runs init, fund, coffees until the channel is exhausted (or --coffees per lifecycle) and close for a number of
+lifecycles and reports the throughput of coffees and p50/p99 latencies per phase. Results are appended to a JSON
+lines file and compared with the previous run of the same options, e.g.
+
+    python benchmark.py --lifecycles 5 --latency 0.02 --speculative --fail-on-regression
+"""
+import argparse
+import json
+import logging
+import tempfile
+import time
+
+import paho.mqtt.client as mqtt
+
+import settings
+from fake_broker import FakeBroker
+from fake_flash import FakeFlashServer
+from machine import PRICE_SINGLE_COFFEE, ChannelManager, State
+
+PHASES = ['init', 'fund', 'make', 'close']
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run(args):
+    servers = [FakeFlashServer(latency=args.latency).start() for _ in range(2)]
+    broker = FakeBroker().start()
+
+    mqtt_client = mqtt.Client(client_id='benchmark')
+    mqtt_client.connect(*broker.address)
+    mqtt_client.loop_start()
+
+    flash_configs = [{'url': server.url, 'username': 'user', 'password': 'password'} for server in servers]
+    http_config = settings.section(settings.read_config(), 'HTTP')
+    manager = ChannelManager(mqtt_client=mqtt_client, flash_configs=flash_configs, http_config=http_config,
+                             speculative=args.speculative, aggregate=args.aggregate, ledger_dir=tempfile.mkdtemp())
+    manager.authenticate()
+    machine = manager.machines[None]
+
+    timings = {phase: [] for phase in PHASES}
+    coffees, errors = 0, 0
+
+    def timed(phase, command, payload=b''):
+        start = time.monotonic()
+        machine.execute_command(command, payload)
+        timings[phase].append(time.monotonic() - start)
+        return machine.current_state != State.ERROR
+
+    start = time.monotonic()
+    for _ in range(args.lifecycles):
+        if not timed('init', 'init') or not timed('fund', 'fund'):
+            errors += 1
+            continue
+        served = 0
+        while (args.coffees is None or served < args.coffees) and machine.channel.digests > 2 \
+                and machine.available_deposit >= PRICE_SINGLE_COFFEE:
+            if not timed('make', 'make', b'single'):
+                errors += 1
+                break
+            served += 1
+        coffees += served
+        if not timed('close', 'close'):
+            errors += 1
+    duration = time.monotonic() - start
+
+    mqtt_client.loop_stop()
+    mqtt_client.disconnect()
+    broker.stop()
+    for server in servers:
+        server.stop()
+
+    return {'duration': duration,
+            'coffees': coffees,
+            'coffees_per_second': coffees / duration if duration else None,
+            'errors': errors,
+            'mqtt_messages': sum(broker.messages.values()),
+            'mqtt_bytes': broker.bytes,
+            'flash_calls': servers[0].calls,
+            'phases': {phase: {'count': len(values),
+                               'p50': percentile(values, 0.5),
+                               'p99': percentile(values, 0.99)} for phase, values in timings.items()}}
+
+
+def previous_result(path, options):
+    """Returns the last result in the results file, which was recorded with the same options."""
+    previous = None
+    try:
+        with open(path) as results:
+            for line in results:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                if result.get('options') == options:
+                    previous = result
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+def regressions(result, previous, tolerance):
+    """Returns the phases, whose median latency got worse than the tolerated ratio."""
+    slower = []
+    for phase, stats in result['phases'].items():
+        old = previous['phases'].get(phase, {}).get('p50')
+        if stats['p50'] and old and stats['p50'] > old * (1 + tolerance):
+            slower.append((phase, old, stats['p50']))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lifecycles', type=int, default=3, help='number of channels opened and closed')
+    parser.add_argument('--coffees', type=int, default=None, help='coffees per lifecycle (default: until exhausted)')
+    parser.add_argument('--latency', type=float, default=0.01, help='latency of each Flash call in seconds')
+    parser.add_argument('--speculative', action='store_true', help='prepare transfers ahead of orders')
+    parser.add_argument('--aggregate', action='store_true', help='aggregate coffees into settlements')
+    parser.add_argument('--results', default='benchmarks.jsonl', help='JSON lines file of recorded results')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='tolerated slowdown of median latencies')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with 1 on regressions')
+    args = parser.parse_args()
+
+    logging.getLogger('coffeemachine').setLevel(logging.WARNING)
+    options = {'lifecycles': args.lifecycles, 'coffees': args.coffees, 'latency': args.latency,
+               'speculative': args.speculative, 'aggregate': args.aggregate}
+
+    result = run(args)
+    result['options'] = options
+    result['time'] = time.time()
+
+    print('{} coffees in {:.2f}s ({:.2f} coffees/s), {} errors, {} MQTT messages ({} bytes)'.format(
+        result['coffees'], result['duration'], result['coffees_per_second'] or 0, result['errors'],
+        result['mqtt_messages'], result['mqtt_bytes']))
+    for phase, stats in result['phases'].items():
+        if stats['count']:
+            print('{:6} n={:4} p50={:8.1f}ms p99={:8.1f}ms'.format(phase, stats['count'], stats['p50'] * 1000,
+                                                                     stats['p99'] * 1000))
+
+    previous = previous_result(args.results, options)
+    with open(args.results, 'a') as results:
+        results.write(json.dumps(result) + '\n')
+
+    if previous:
+        slower = regressions(result, previous, args.tolerance)
+        for phase, old, new in slower:
+            print('Regression of {}: p50 {:.1f}ms -> {:.1f}ms'.format(phase, old * 1000, new * 1000))
+        if slower and args.fail_on_regression:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+class ChannelState:
+    """In-memory model of a Flash channel of a coffee machine.
+
+    The channel is bound to the Flash clients holding its channel ids, so that a machine can switch between
+    channels by switching between their states. Consecutive flash objects returned by the Flash servers are
+    compared to derive compact deltas, so that only the changes of a payment need to be published instead of the
+    whole flash objects.
+    """
+
+    def __init__(self, flash_clients):
+        self.flash_clients = flash_clients
+        self.flash_objects = [None] * len(flash_clients)
+        self.settlement_addresses = []
+        self.sequence = 0
+        # coffees served via the channel
+        self.coffees = 0
+
+    @property
+    def channel_ids(self):
+        return [client.channel_id for client in self.flash_clients]
+
+    @property
+    def flash(self):
+        return self.flash_objects[0]['flash']
+
+    @property
+    def deposit(self):
+        return self.flash['deposit']
+
+    @property
+    def digests(self):
+        """Number of multisig digests (i.e. transactions) left in the channel."""
+        return len(self.flash['multisigDigestPool'])
+
+    def record(self):
+        """Returns the state of the channel, which is needed to resume it."""
+        return {'channel_ids': self.channel_ids,
+                'settlement_addresses': self.settlement_addresses,
+                'flash_objects': self.flash_objects,
+                'sequence': self.sequence,
+                'coffees': self.coffees}
+
+    def restore(self, record):
+        for client, channel_id in zip(self.flash_clients, record['channel_ids']):
+            client.channel_id = channel_id
+        self.settlement_addresses[:] = record['settlement_addresses']
+        self.flash_objects[:] = record['flash_objects']
+        self.sequence = record['sequence']
+        self.coffees = record.get('coffees', 0)
+
+    def reset(self, flash_objects):
+        """Starts the model of a new channel and returns its initial delta."""
+        self.flash_objects[:] = flash_objects
+        self.sequence = 0
+        self.coffees = 0
+        return self.delta()
+
+    def update(self, flash_objects, bundle_hashes, coffees=0):
+        """Applies new flash objects (paying for a number of coffees) and returns the delta to the previous ones."""
+        deposit, digests = list(self.deposit), self.digests
+        self.flash_objects[:] = flash_objects
+        self.sequence += 1
+        self.coffees += coffees
+        return self.delta(deposit=deposit, digests=digests, bundle_hashes=bundle_hashes)
+
+    def delta(self, deposit=None, digests=None, bundle_hashes=()):
+        """Returns the delta of the channel to a previous deposit and number of digests."""
+        deposit = self.deposit if deposit is None else deposit
+        digests = self.digests if digests is None else digests
+        return {'sequence': self.sequence,
+                'deposit': self.deposit,
+                'deposit_change': [new - old for new, old in zip(self.deposit, deposit)],
+                'digests': self.digests,
+                'digests_consumed': digests - self.digests,
+                'bundle_hashes': list(bundle_hashes)}
@@ -0,0 +1,99 @@
+import json
+import string
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+ENCODINGS = ('json', 'msgpack', 'cbor')
+
+TRYTES = '9' + string.ascii_uppercase
+TRYTE_VALUES = {tryte: value for value, tryte in enumerate(TRYTES)}
+
+# strings of at least this many trytes (hashes, addresses, signatures, ...) are packed
+MIN_PACKED_TRYTES = 27
+
+# extension type (MessagePack) and tag (CBOR) of packed trytes
+TRYTES_EXT_TYPE = 27
+TRYTES_TAG = 27027
+
+
+def topic(base_topic, encoding):
+    """Returns the topic of a payload in an encoding (e.g. /coffee/flash/msgpack), JSON uses the plain topic."""
+    return base_topic if encoding == 'json' else '{}/{}'.format(base_topic, encoding)
+
+
+def check(encoding):
+    if encoding not in ENCODINGS:
+        raise ValueError('Unknown encoding {}'.format(encoding))
+    if (encoding == 'msgpack' and msgpack is None) or (encoding == 'cbor' and cbor2 is None):
+        raise ValueError('Encoding {} requires the package {}'.format(encoding, {'msgpack': 'msgpack',
+                                                                                 'cbor': 'cbor2'}[encoding]))
+
+
+def is_trytes(value):
+    return len(value) >= MIN_PACKED_TRYTES and all(c in TRYTE_VALUES for c in value)
+
+
+def pack_trytes(trytes):
+    """Packs trytes into 3 bytes per 5 trytes (27^5 < 2^24), prefixed by the number of trytes."""
+    data = bytearray(struct.pack('!I', len(trytes)))
+    for idx in range(0, len(trytes), 5):
+        value = 0
+        for tryte in trytes[idx:idx + 5].ljust(5, '9'):
+            value = value * 27 + TRYTE_VALUES[tryte]
+        data += value.to_bytes(3, 'big')
+    return bytes(data)
+
+
+def unpack_trytes(data):
+    length = struct.unpack('!I', data[:4])[0]
+    trytes = []
+    for idx in range(4, len(data), 3):
+        value = int.from_bytes(data[idx:idx + 3], 'big')
+        group = []
+        for _ in range(5):
+            value, tryte = divmod(value, 27)
+            group.append(TRYTES[tryte])
+        trytes.extend(reversed(group))
+    return ''.join(trytes[:length])
+
+
+def _pack(value, wrap):
+    if isinstance(value, str) and is_trytes(value):
+        return wrap(pack_trytes(value))
+    if isinstance(value, dict):
+        return {k: _pack(v, wrap) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_pack(v, wrap) for v in value]
+    return value
+
+
+def encode(payload, encoding='json'):
+    """Encodes a payload as JSON or as MessagePack/CBOR with packed trytes."""
+    if encoding == 'msgpack':
+        return msgpack.packb(_pack(payload, lambda data: msgpack.ExtType(TRYTES_EXT_TYPE, data)), use_bin_type=True)
+    if encoding == 'cbor':
+        return cbor2.dumps(_pack(payload, lambda data: cbor2.CBORTag(TRYTES_TAG, data)))
+    return json.dumps(payload)
+
+
+def decode(data, encoding='json'):
+    if encoding == 'msgpack':
+        def ext_hook(code, ext_data):
+            return unpack_trytes(ext_data) if code == TRYTES_EXT_TYPE else msgpack.ExtType(code, ext_data)
+        return msgpack.unpackb(data, ext_hook=ext_hook, raw=False)
+    if encoding == 'cbor':
+        def tag_hook(*args):
+            # called with (decoder, tag) or (tag, immutable), depending on the version of cbor2
+            tag = next(arg for arg in args if isinstance(arg, cbor2.CBORTag))
+            return unpack_trytes(tag.value) if tag.tag == TRYTES_TAG else tag
+        return cbor2.loads(data, tag_hook=tag_hook)
+    return json.loads(data.decode('utf-8') if isinstance(data, bytes) else data)
@@ -0,0 +1,83 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import queue
+
+from metrics import REGISTRY
+
+logger = logging.getLogger('coffeemachine')
+
+COMMANDS_COALESCED = REGISTRY.counter('coffee_commands_coalesced_total', 'Pending commands merged with a duplicate')
+
+COALESCED_COMMANDS = ('init', 'fund', 'close', 'snapshot', 'settle')
+
+# order of serving pending commands (control commands first in order of arrival, since e.g. funding must not
+# overtake the init of the channel it funds, and orders of coffee last)
+PRIORITIES = {'close': 0, 'fund': 0, 'init': 0, 'settle': 0, 'snapshot': 0, 'make': 1}
+
+
+def priority(command):
+    return PRIORITIES.get(command, max(PRIORITIES.values()))
+
+
+class PriorityCommands:
+    """Bounded priority queue of MQTT commands (command, payload) of a coffee machine.
+
+    Control commands are served in order of arrival before orders of coffee, so that e.g. funding never overtakes
+    the init of the channel it funds. Control commands, which are already pending or running, are coalesced instead
+    of being queued twice. Orders of coffee are never coalesced, since every press of a button must be served.
+
+    A full queue sheds the newest command of lowest priority, so that a backlog of orders never holds back closing or
+    funding the channel. Mixed into asyncio.Queue and queue.Queue, which call _init, _qsize, _put and _get.
+    """
+
+    def _init(self, maxsize):
+        self._queue = []
+        self._counter = itertools.count()
+        self.running = None
+
+    def _qsize(self):
+        return len(self._queue)
+
+    def _put(self, item):
+        heapq.heappush(self._queue, (priority(item[0]), next(self._counter), item))
+
+    def _get(self):
+        return heapq.heappop(self._queue)[-1]
+
+    def _make_room(self, item):
+        """Returns whether item is to be queued and the pending command, which was shed for it."""
+        command = item[0]
+        if command in COALESCED_COMMANDS and (item == self.running or any(e[-1] == item for e in self._queue)):
+            logger.info('Coalescing {}'.format(command))
+            COMMANDS_COALESCED.inc(command=command)
+            return False, None
+
+        if 0 < self.maxsize <= len(self._queue):
+            lowest = max(self._queue)
+            if lowest[0] <= priority(command):
+                return False, item
+            self._queue.remove(lowest)
+            heapq.heapify(self._queue)
+            return True, lowest[-1]
+        return True, None
+
+
+class CommandQueue(PriorityCommands, asyncio.Queue):
+    def offer(self, item):
+        """Queues a command without blocking and returns the command shed by a full queue (if any)."""
+        accepted, dropped = self._make_room(item)
+        if accepted:
+            self.put_nowait(item)
+        return dropped
+
+
+class ThreadCommandQueue(PriorityCommands, queue.Queue):
+    def offer(self, item):
+        """Queues a command without blocking and returns the command shed by a full queue (if any)."""
+        with self.mutex:
+            accepted, dropped = self._make_room(item)
+        if accepted:
+            self.put_nowait(item)
+        return dropped
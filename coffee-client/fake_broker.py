@@ -0,0 +1,187 @@
+import socket
+import struct
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from threading import Lock, Thread
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def topic_matches(subscription, topic):
+    """Checks whether a topic matches a subscription with + and # wildcards."""
+    sub_levels, topic_levels = subscription.split('/'), topic.split('/')
+    for idx, level in enumerate(sub_levels):
+        if level == '#':
+            return True
+        if idx >= len(topic_levels) or (level != '+' and level != topic_levels[idx]):
+            return False
+    return len(sub_levels) == len(topic_levels)
+
+
+def encode_string(value):
+    data = value.encode('utf-8')
+    return struct.pack('!H', len(data)) + data
+
+
+def encode_packet(packet_type, flags, body):
+    header = bytes([(packet_type << 4) | flags])
+    length, remaining = b'', len(body)
+    while True:
+        byte, remaining = remaining % 128, remaining // 128
+        length += bytes([byte | 0x80 if remaining else byte])
+        if not remaining:
+            return header + length + body
+
+
+class FakeBroker:
+    """Minimal in-process MQTT 3.1.1 broker for local benchmarks of the coffee client.
+
+    Supports QoS 0 and 1 (published at most with QoS 1), retained messages and wildcard subscriptions, which is
+    everything the coffee client and Home Assistant need. Authentication is not checked and sessions are not
+    persisted. Counts the messages and bytes published per topic.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.sessions = []
+        self.retained = {}
+        self.lock = Lock()
+        self.messages = {}
+        self.bytes = 0
+
+        broker = self
+
+        class Handler(StreamRequestHandler):
+            def handle(self):
+                session = Session(broker, self.connection)
+                try:
+                    session.serve(self.rfile)
+                except (OSError, ValueError):
+                    pass
+                finally:
+                    broker.remove(session)
+
+        ThreadingTCPServer.allow_reuse_address = True
+        self.server = ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            for session in self.sessions:
+                session.close()
+
+    def remove(self, session):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        with self.lock:
+            self.messages[topic] = self.messages.get(topic, 0) + 1
+            self.bytes += len(payload)
+            if retain:
+                if payload:
+                    self.retained[topic] = (payload, qos)
+                else:
+                    self.retained.pop(topic, None)
+            sessions = list(self.sessions)
+        for session in sessions:
+            session.deliver(topic, payload, qos)
+
+
+class Session:
+    def __init__(self, broker, connection):
+        self.broker = broker
+        self.connection = connection
+        self.subscriptions = {}
+        self.write_lock = Lock()
+        self.packet_id = 0
+
+    def serve(self, stream):
+        while True:
+            header = stream.read(1)
+            if not header:
+                return
+            packet_type, flags = header[0] >> 4, header[0] & 0x0f
+            length, multiplier = 0, 1
+            while True:
+                byte = stream.read(1)[0]
+                length += (byte & 0x7f) * multiplier
+                multiplier *= 128
+                if not byte & 0x80:
+                    break
+            body = stream.read(length)
+            if packet_type == DISCONNECT:
+                return
+            self.dispatch(packet_type, flags, body)
+
+    def dispatch(self, packet_type, flags, body):
+        if packet_type == CONNECT:
+            self.send(CONNACK, 0, b'\x00\x00')
+            with self.broker.lock:
+                self.broker.sessions.append(self)
+        elif packet_type == PUBLISH:
+            qos, retain = (flags >> 1) & 0x03, bool(flags & 0x01)
+            topic_length = struct.unpack('!H', body[:2])[0]
+            topic, offset = body[2:2 + topic_length].decode('utf-8'), 2 + topic_length
+            if qos:
+                self.send(PUBACK, 0, body[offset:offset + 2])
+                offset += 2
+            self.broker.publish(topic, body[offset:], qos=qos, retain=retain)
+        elif packet_type == SUBSCRIBE:
+            packet_id, offset, granted = body[:2], 2, []
+            while offset < len(body):
+                topic_length = struct.unpack('!H', body[offset:offset + 2])[0]
+                topic = body[offset + 2:offset + 2 + topic_length].decode('utf-8')
+                qos = min(body[offset + 2 + topic_length], 1)
+                offset += 3 + topic_length
+                self.subscriptions[topic] = qos
+                granted.append(qos)
+            self.send(SUBACK, 0, packet_id + bytes(granted))
+            with self.broker.lock:
+                retained = list(self.broker.retained.items())
+            for topic, (payload, qos) in retained:
+                self.deliver(topic, payload, qos, retain=True)
+        elif packet_type == UNSUBSCRIBE:
+            offset = 2
+            while offset < len(body):
+                topic_length = struct.unpack('!H', body[offset:offset + 2])[0]
+                self.subscriptions.pop(body[offset + 2:offset + 2 + topic_length].decode('utf-8'), None)
+                offset += 2 + topic_length
+            self.send(UNSUBACK, 0, body[:2])
+        elif packet_type == PINGREQ:
+            self.send(PINGRESP, 0, b'')
+
+    def deliver(self, topic, payload, qos, retain=False):
+        granted = [q for subscription, q in list(self.subscriptions.items()) if topic_matches(subscription, topic)]
+        if not granted:
+            return
+        qos = min(qos, max(granted))
+        body = encode_string(topic)
+        if qos:
+            self.packet_id = self.packet_id % 65535 + 1
+            body += struct.pack('!H', self.packet_id)
+        try:
+            self.send(PUBLISH, (qos << 1) | int(retain), body + payload)
+        except OSError:
+            pass
+
+    def send(self, packet_type, flags, body):
+        with self.write_lock:
+            self.connection.sendall(encode_packet(packet_type, flags, body))
+
+    def close(self):
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
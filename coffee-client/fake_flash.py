@@ -0,0 +1,195 @@
+import base64
+import json
+import random
+import string
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Semaphore, Thread
+
+TRYTES = string.ascii_uppercase + '9'
+
+
+def random_trytes(length=81):
+    return ''.join(random.choice(TRYTES) for _ in range(length))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeFlashServer:
+    """In-process stand-in for a Flash server, implementing the HTTP API used by FlashClient.
+
+    Channels are kept in memory and follow the Flash API closely enough to run whole channel lifecycles: transfers
+    move value between the deposits of the parties, each applied bundle consumes a multisig digest and funding or
+    finalising returns fake transactions instead of attaching to the Tangle. Every call is delayed by latency
+    seconds, which can be overridden per endpoint (e.g. {'fund': 2.0}). Tokens are JWTs expiring after
+    token_lifetime seconds (or never).
+
+    With a concurrency, at most that many calls are processed at once (e.g. 1 for the single-threaded Flash server),
+    so that calls queue up under load. The time each call spent in the server is recorded in latencies.
+    """
+
+    def __init__(self, latency=0.0, endpoint_latency=None, token_lifetime=None, concurrency=None, host='127.0.0.1',
+                 port=0):
+        self.latency = latency
+        self.endpoint_latency = endpoint_latency or {}
+        self.token_lifetime = token_lifetime
+        self.workers = Semaphore(concurrency) if concurrency else None
+        self.tokens = {}
+        self.channels = {}
+        self.lock = Lock()
+        self.calls = {}
+        self.latencies = {}
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length).decode('utf-8') or '{}') if length else {}
+                status, response = server.handle(self.path, body, self.headers)
+                payload = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.thread = Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def handle(self, path, body, headers):
+        parts = path.strip('/').split('/')
+        endpoint = parts[1] if parts[0] == 'flash' else parts[0]
+        channel_id = parts[2] if len(parts) > 2 else None
+
+        start = time.monotonic()
+        if self.workers:
+            self.workers.acquire()
+        try:
+            return self.respond(endpoint, channel_id, body, headers)
+        finally:
+            if self.workers:
+                self.workers.release()
+            with self.lock:
+                self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+                self.latencies.setdefault(endpoint, []).append(time.monotonic() - start)
+
+    def respond(self, endpoint, channel_id, body, headers):
+        time.sleep(self.endpoint_latency.get(endpoint, self.latency))
+
+        if endpoint == 'token':
+            return 200, {'token': self.issue_token()}
+        token = headers.get('authorization', '')[len('Bearer '):]
+        if self.tokens.get(token, 0) < time.time():
+            return 401, {'error': 'Unauthorized'}
+        if endpoint == 'init':
+            return 200, self.init(**body)
+        if endpoint == 'settlement_address':
+            return 200, {'address': random_trytes()}
+
+        handler = getattr(self, endpoint, None)
+        with self.lock:
+            channel = self.channels.get(channel_id)
+            if handler is None or channel is None:
+                return 404, {'error': 'Unknown channel {}'.format(channel_id)}
+            try:
+                return 200, handler(channel, **body)
+            except ValueError as e:
+                return 400, {'error': str(e)}
+
+    def issue_token(self):
+        expires = time.time() + self.token_lifetime if self.token_lifetime else float('inf')
+        claims = {'jti': uuid.uuid4().hex}
+        if self.token_lifetime:
+            claims['exp'] = int(expires)
+        encode = lambda part: base64.urlsafe_b64encode(json.dumps(part).encode('utf-8')).decode('utf-8').rstrip('=')
+        token = '.'.join([encode({'alg': 'none'}), encode(claims), ''])
+        self.tokens[token] = expires
+        return token
+
+    def init(self, userIndex, security, depth, signersCount, balance, deposit):
+        channel_id = uuid.uuid4().hex
+        user = {'userIndex': userIndex, 'security': security, 'depth': depth, 'bundles': [],
+                'partialDigests': [random_trytes() for _ in range(2 ** depth)],
+                'flash': {'signersCount': signersCount, 'balance': balance, 'deposit': list(deposit),
+                          'depth': depth, 'security': security, 'outputs': {}, 'transfers': [],
+                          'multisigDigestPool': [], 'settlementAddresses': []}}
+        with self.lock:
+            self.channels[channel_id] = user
+        return {'channelId': channel_id, 'flash': user}
+
+    def multisignature(self, user, allDigests):
+        user['flash']['multisigDigestPool'] = [random_trytes() for _ in allDigests[0]]
+        return user
+
+    def settlement(self, user, settlementAddresses):
+        user['flash']['settlementAddresses'] = settlementAddresses
+        return user
+
+    def transfer(self, user, transfers):
+        value = sum(t['value'] for t in transfers)
+        if user['flash']['deposit'][user['userIndex']] < value:
+            raise ValueError('Insufficient funds')
+        if not user['flash']['multisigDigestPool']:
+            raise ValueError('No digests left')
+        bundle = random_trytes()
+        transactions = [{'bundle': bundle, 'address': t['address'], 'value': t['value']} for t in transfers]
+        transactions.append({'bundle': bundle, 'address': random_trytes(), 'value': -value,
+                             'sender': user['userIndex']})
+        return [transactions]
+
+    def sign(self, user, bundles):
+        for bundle in bundles:
+            for transaction in bundle:
+                transaction.setdefault('signatures', []).append(user['userIndex'])
+        return bundles
+
+    def apply(self, user, signedBundles):
+        for bundle in signedBundles:
+            if not user['flash']['multisigDigestPool']:
+                raise ValueError('No digests left')
+            user['flash']['multisigDigestPool'].pop()
+            for transaction in bundle:
+                if 'sender' in transaction:
+                    user['flash']['deposit'][transaction['sender']] += transaction['value']
+                else:
+                    outputs = user['flash']['outputs']
+                    outputs[transaction['address']] = outputs.get(transaction['address'], 0) + transaction['value']
+            user['flash']['transfers'].append(bundle)
+            user['bundles'].append(bundle)
+        return user
+
+    def close(self, user):
+        bundle = random_trytes()
+        return [[{'bundle': bundle, 'address': address, 'value': 0}
+                 for address in user['flash']['settlementAddresses']]]
+
+    def fund(self, user):
+        return [{'bundle': random_trytes(), 'hash': random_trytes(), 'value': user['flash']['deposit'][0]}]
+
+    def finalize(self, user):
+        return [{'bundle': random_trytes(), 'hash': random_trytes()}]
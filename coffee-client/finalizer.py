@@ -0,0 +1,169 @@
+import logging
+import queue
+import time
+from threading import Thread
+
+import requests
+
+import metrics
+
+logger = logging.getLogger('coffeemachine')
+
+TRYTES = '9ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+# position of the current index within the trytes of a transaction
+CURRENT_INDEX = slice(2331, 2340)
+
+FINALIZATIONS = metrics.REGISTRY.counter('coffee_finalizations_total', 'Progress of finalising closed channels')
+
+
+def trytes_to_int(trytes):
+    """Decodes balanced ternary trytes (least significant first) into an integer."""
+    value = 0
+    for tryte in reversed(trytes):
+        digit = TRYTES.index(tryte)
+        value = value * 27 + (digit - 27 if digit > 13 else digit)
+    return value
+
+
+class IriClient:
+    """Minimal client of the HTTP API of an IRI node for tracking and reattaching bundles."""
+
+    def __init__(self, url, timeout=30, session=None):
+        self.url = url
+        self.timeout = float(timeout)
+        self.session = session or requests.Session()
+
+    def call(self, command, **params):
+        response = self.session.post(self.url, json=dict(params, command=command), timeout=self.timeout,
+                                     headers={'X-IOTA-API-Version': '1'})
+        response.raise_for_status()
+        return response.json()
+
+    def tails(self, bundle_hash):
+        """Returns the hashes of the tail transactions of all attachments of a bundle."""
+        hashes = self.call('findTransactions', bundles=[bundle_hash])['hashes']
+        if not hashes:
+            return []
+        trytes = self.call('getTrytes', hashes=hashes)['trytes']
+        return [h for h, t in zip(hashes, trytes) if trytes_to_int(t[CURRENT_INDEX]) == 0]
+
+    def confirmed(self, bundle_hash):
+        """Returns whether an attachment of a bundle is confirmed by the latest solid milestone."""
+        tails = self.tails(bundle_hash)
+        if not tails:
+            return False
+        milestone = self.call('getNodeInfo')['latestSolidSubtangleMilestone']
+        return any(self.call('getInclusionStates', transactions=tails, tips=[milestone])['states'])
+
+    def reattach(self, bundle_hash, depth, min_weight_magnitude):
+        """Attaches the transactions of a bundle again on top of new tips."""
+        hashes = self.call('findTransactions', bundles=[bundle_hash])['hashes']
+        by_index = {}
+        for trytes in self.call('getTrytes', hashes=hashes)['trytes']:
+            by_index.setdefault(trytes_to_int(trytes[CURRENT_INDEX]), trytes)
+        if not by_index:
+            raise ValueError('Bundle {} not found'.format(bundle_hash))
+
+        # transactions are attached from the head to the tail
+        tips = self.call('getTransactionsToApprove', depth=depth)
+        attached = self.call('attachToTangle', trunkTransaction=tips['trunkTransaction'],
+                             branchTransaction=tips['branchTransaction'], minWeightMagnitude=min_weight_magnitude,
+                             trytes=[by_index[index] for index in sorted(by_index, reverse=True)])['trytes']
+        self.call('storeTransactions', trytes=attached)
+        self.call('broadcastTransactions', trytes=attached)
+
+
+class Finalizer:
+    """Finalises closed channels in the background, so that closing does not wait for the Tangle.
+
+    A job attaches the settlement bundles of a closed channel via its Flash server (which does the proof of work)
+    and, with an IRI node, polls every poll_interval seconds until they are confirmed. Failed attachments are retried
+    with the next poll and bundles not confirmed within confirm_timeout seconds are reattached via the IRI node, up
+    to max_attempts attachments in total. Each step is reported to the progress callback of the job with its record
+    (channel id, status, bundle hashes and attempts).
+    """
+
+    def __init__(self, iri=None, poll_interval=30, confirm_timeout=600, max_attempts=4, depth=3,
+                 min_weight_magnitude=14):
+        self.iri = iri
+        self.poll_interval = float(poll_interval)
+        self.confirm_timeout = float(confirm_timeout)
+        self.max_attempts = int(max_attempts)
+        self.depth = int(depth)
+        self.min_weight_magnitude = int(min_weight_magnitude)
+        self.submitted = queue.Queue()
+        self.jobs = []
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.run, name='Finalizer', daemon=True)
+        self.thread.start()
+        return self
+
+    def submit(self, flash_client, record, progress):
+        """Finalises the channel of flash_client, resuming from a record of a previous job (or a new record)."""
+        job = {'client': flash_client, 'progress': progress,
+               'record': dict({'status': 'closed', 'bundle_hashes': [], 'attempts': 0, 'attached': None}, **record)}
+        self.report(job, job['record']['status'])
+        self.submitted.put(job)
+
+    def run(self):
+        while True:
+            try:
+                self.jobs.append(self.submitted.get(timeout=self.poll_interval if self.jobs else None))
+            except queue.Empty:
+                pass
+            for job in list(self.jobs):
+                self.step(job)
+                if self.done(job['record']):
+                    self.jobs.remove(job)
+
+    def done(self, record):
+        """Returns whether a job is confirmed or failed, or attached if confirmations cannot be tracked."""
+        return record['status'] in ('confirmed', 'failed') or (self.iri is None and record['status'] != 'closed')
+
+    def step(self, job):
+        record = job['record']
+        try:
+            if record['status'] == 'closed':
+                self.attach(job)
+            elif all(self.iri.confirmed(bundle_hash) for bundle_hash in record['bundle_hashes']):
+                self.report(job, 'confirmed')
+            elif time.time() - record['attached'] >= self.confirm_timeout:
+                self.reattach(job)
+        except:
+            logger.exception('Error while finalising channel {}'.format(record['channel_id']))
+            if record['status'] == 'closed' and record['attempts'] >= self.max_attempts:
+                self.report(job, 'failed')
+
+    def attach(self, job):
+        record = job['record']
+        logger.info('Finalising channel {}'.format(record['channel_id']))
+        record['attempts'] += 1
+        transactions = job['client'].finalize()
+        record['bundle_hashes'] = sorted({tx['bundle'] for tx in transactions})
+        record['attached'] = time.time()
+        self.report(job, 'attached')
+
+    def reattach(self, job):
+        record = job['record']
+        if record['attempts'] >= self.max_attempts:
+            self.report(job, 'failed')
+            return
+        logger.info('Reattaching bundles of channel {}'.format(record['channel_id']))
+        record['attempts'] += 1
+        record['attached'] = time.time()
+        for bundle_hash in record['bundle_hashes']:
+            if not self.iri.confirmed(bundle_hash):
+                self.iri.reattach(bundle_hash, depth=self.depth, min_weight_magnitude=self.min_weight_magnitude)
+        self.report(job, 'reattached')
+
+    @staticmethod
+    def report(job, status):
+        job['record']['status'] = status
+        FINALIZATIONS.inc(status=status)
+        try:
+            job['progress'](dict(job['record']))
+        except:
+            logger.exception('Error while reporting finalisation of channel {}'.format(job['record']['channel_id']))
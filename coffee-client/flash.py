@@ -0,0 +1,205 @@
+import base64
+import copy
+import json
+import logging
+import time
+from threading import Lock, Timer
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+logger = logging.getLogger('coffeemachine')
+
+# instrumentation of Flash calls
+FLASH_LATENCY = metrics.REGISTRY.histogram('flash_request_seconds', 'Latency of calls to Flash servers')
+FLASH_ERRORS = metrics.REGISTRY.counter('flash_request_errors_total', 'Failed calls to Flash servers')
+TOKEN_REFRESHES = metrics.REGISTRY.counter('flash_token_refreshes_total', 'Tokens fetched from Flash servers')
+
+# errors of servers, which are not (yet) reachable
+NOT_READY_ERRORS = (requests.ConnectionError, requests.Timeout)
+
+
+def create_session(pool_size=4, retries=3, backoff=0.5):
+    """Creates a session keeping a pool of connections to a Flash server alive.
+
+    Connection errors are retried for every call, since the request never reached the server.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=int(pool_size),
+                          max_retries=Retry(total=int(retries), connect=int(retries), read=0, status=0,
+                                            backoff_factor=float(backoff)))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class Token:
+    """Bearer token of a Flash server, which is shared by all clients of the server.
+
+    The expiry is read from the exp claim of JWTs and otherwise assumed lifetime seconds after fetching the token.
+    """
+
+    def __init__(self, lifetime=3600, refresh_margin=60):
+        self.lifetime = float(lifetime)
+        self.refresh_margin = float(refresh_margin)
+        self.value = None
+        self.expires = 0
+        self.lock = Lock()
+        self.timer = None
+
+    @property
+    def expired(self):
+        return self.value is None or time.time() >= self.expires
+
+    def update(self, value):
+        self.value = value
+        self.expires = self.expiry(value) or time.time() + self.lifetime
+
+    @staticmethod
+    def expiry(value):
+        try:
+            claims = value.split('.')[1]
+            claims = json.loads(base64.urlsafe_b64decode(claims + '=' * (-len(claims) % 4)).decode('utf-8'))
+            return float(claims['exp'])
+        except (IndexError, KeyError, TypeError, ValueError):
+            return None
+
+
+class FlashClient:
+    RETRY_STATUS_CODES = (502, 503, 504)
+
+    def __init__(self, url, username=None, password=None, pool_size=4, connect_timeout=3.05,
+                 read_timeout=120, retries=3, backoff=0.5, token_lifetime=3600, token_refresh=60, session=None,
+                 token=None):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.channel_id = None
+        self.token = token or Token(lifetime=token_lifetime, refresh_margin=token_refresh)
+        self.timeout = (float(connect_timeout), float(read_timeout))
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+
+        # keep-alive connections to the flash server, which are reused by all calls (and possibly other clients)
+        self.session = session or create_session(pool_size=pool_size, retries=retries, backoff=backoff)
+
+    def fork(self):
+        """Returns a client for another channel, sharing connections and token with this client."""
+        client = copy.copy(self)
+        client.channel_id = None
+        return client
+
+    def authenticate(self, stale=None):
+        """Fetches a token, unless a valid token other than the rejected token stale is cached already."""
+        with self.token.lock:
+            if not self.token.expired and self.token.value != stale:
+                return
+            reason = 'initial' if self.token.value is None else 'expired' if stale is None else 'rejected'
+            self._fetch_token(reason)
+
+    def refresh_token(self):
+        """Replaces the token in the background before it expires, so that no call is rejected."""
+        with self.token.lock:
+            try:
+                self._fetch_token('proactive')
+            except:
+                logger.exception('Error while refreshing token of {}'.format(self.url))
+                self._schedule_refresh(delay=min(30, max(0, self.token.expires - time.time())))
+
+    def _fetch_token(self, reason):
+        auth = (self.username, self.password) if self.username else None
+        response = self._post(path='/token', auth=auth, idempotent=True)
+        self.token.update(response['token'])
+        TOKEN_REFRESHES.inc(server=self.url, reason=reason)
+        self._schedule_refresh(delay=self.token.expires - self.token.refresh_margin - time.time())
+
+    def _schedule_refresh(self, delay):
+        if self.token.timer:
+            self.token.timer.cancel()
+        self.token.timer = Timer(max(1, delay), self.refresh_token)
+        self.token.timer.daemon = True
+        self.token.timer.start()
+
+    def init(self, **kwargs):
+        response = self._post(path='/flash/init', **kwargs)
+        self.channel_id = response['channelId']
+        return response['flash']
+
+    def multisignature(self, **kwargs):
+        return self._post(path='/flash/multisignature/' + self.channel_id, **kwargs)
+
+    def settlement(self, **kwargs):
+        return self._post(path='/flash/settlement/' + self.channel_id, **kwargs)
+
+    def settlement_address(self, **kwargs):
+        return self._post(path='/flash/settlement_address', idempotent=True, **kwargs)
+
+    def transfer(self, **kwargs):
+        return self._post(path='/flash/transfer/' + self.channel_id, **kwargs)
+
+    def sign(self, **kwargs):
+        return self._post(path='/flash/sign/' + self.channel_id, **kwargs)
+
+    def apply(self, **kwargs):
+        return self._post(path='/flash/apply/' + self.channel_id, **kwargs)
+
+    def close(self, **kwargs):
+        return self._post(path='/flash/close/' + self.channel_id, **kwargs)
+
+    def fund(self, **kwargs):
+        return self._post(path='/flash/fund/' + self.channel_id, **kwargs)
+
+    def finalize(self, **kwargs):
+        return self._post(path='/flash/finalize/' + self.channel_id, **kwargs)
+
+    def _post(self, path, auth=None, idempotent=False, **kwargs):
+        # label calls by endpoint without channel id (e.g. /flash/sign/<channel_id> -> sign)
+        parts = path.strip('/').split('/')
+        labels = {'endpoint': parts[1] if parts[0] == 'flash' else parts[0], 'server': self.url}
+
+        # expired tokens are replaced before the call, rejected ones are replaced and the call is replayed once
+        if path != '/token' and self.token.expired:
+            self.authenticate()
+        token = self.token.value if path != '/token' else None
+
+        start = time.monotonic()
+        try:
+            response = self._request(path, auth=auth, idempotent=idempotent, payload=kwargs, token=token)
+            if response.status_code == 401 and path != '/token':
+                logger.info('Token rejected by {}, re-authenticating'.format(self.url))
+                self.authenticate(stale=token)
+                response = self._request(path, auth=auth, idempotent=idempotent, payload=kwargs,
+                                         token=self.token.value)
+        except requests.RequestException:
+            FLASH_ERRORS.inc(**labels)
+            raise
+        finally:
+            FLASH_LATENCY.observe(time.monotonic() - start, **labels)
+
+        if response.status_code >= 400:
+            FLASH_ERRORS.inc(**labels)
+            logger.info(response.text)
+        response.raise_for_status()
+        return response.json()
+
+    def _request(self, path, auth, idempotent, payload, token=None):
+        headers = {}
+        if token:
+            headers['authorization'] = "Bearer " + token
+
+        # reads are only retried for idempotent calls
+        attempts = self.retries + 1 if idempotent else 1
+        for attempt in range(1, attempts + 1):
+            try:
+                response = self.session.post(self.url + path, json=payload, auth=auth, headers=headers,
+                                             timeout=self.timeout)
+                if response.status_code not in self.RETRY_STATUS_CODES or attempt == attempts:
+                    return response
+            except requests.ReadTimeout:
+                if attempt == attempts:
+                    raise
+            logger.info('Retrying {}{} ({}/{})'.format(self.url, path, attempt, self.retries))
+            time.sleep(self.backoff * 2 ** (attempt - 1))
@@ -0,0 +1,60 @@
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger('coffeemachine')
+
+
+class Ledger:
+    """Persisted ledger of coffees, which were served but not yet paid via the Flash channel.
+
+    Each coffee is appended to the ledger file (and synced to disk) before it is served, so that unsettled coffees
+    survive a crash of the client and are paid with the next settlement. Paid coffees are removed by the time of
+    the last coffee of their settlement, so that removing them again (e.g. after recovering the settlement) does not
+    remove coffees served afterwards.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        if os.path.exists(path):
+            with open(path) as ledger_file:
+                for line in ledger_file:
+                    try:
+                        self.entries.append(json.loads(line))
+                    except ValueError:
+                        logger.warning('Skipping corrupted ledger entry {}'.format(line.strip()))
+        if self.entries:
+            logger.info('Loaded {} unsettled coffees from {}'.format(len(self.entries), path))
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def value(self):
+        return sum(entry['value'] for entry in self.entries)
+
+    @property
+    def since(self):
+        """Time of the oldest unsettled coffee."""
+        return self.entries[0]['time'] if self.entries else None
+
+    def add(self, value, mode):
+        entry = {'time': time.time(), 'value': value, 'mode': mode}
+        with open(self.path, 'a') as ledger_file:
+            ledger_file.write(json.dumps(entry) + '\n')
+            ledger_file.flush()
+            os.fsync(ledger_file.fileno())
+        self.entries.append(entry)
+
+    def clear(self, until=None):
+        """Removes the coffees served up to time until (all coffees without until), which have been paid."""
+        entries = [] if until is None else [entry for entry in self.entries if entry['time'] > until]
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as ledger_file:
+            ledger_file.writelines(json.dumps(entry) + '\n' for entry in entries)
+            ledger_file.flush()
+            os.fsync(ledger_file.fileno())
+        os.replace(tmp_path, self.path)
+        self.entries = entries
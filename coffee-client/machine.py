@@ -0,0 +1,750 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from threading import Lock, Thread, Timer
+
+import paho.mqtt.client as mqtt
+
+import codec
+import metrics
+from channel import ChannelState
+from commands import CommandQueue, ThreadCommandQueue
+from flash import NOT_READY_ERRORS, FlashClient, Token, create_session
+from ledger import Ledger
+from readiness import wait_for
+
+logger = logging.getLogger('coffeemachine')
+
+PRICE_SINGLE_COFFEE = 300000
+
+TOPIC_ROOT = '/coffee'
+COMMANDS = ['make', 'init', 'fund', 'close', 'snapshot', 'settle']
+
+# parameters of Flash channels
+SECURITY = 2
+TREE_DEPTH = 4
+SIGNERS_COUNT = 2
+BALANCE = int(20e6)
+DEPOSIT = [BALANCE // 2, BALANCE // 2]
+
+# instrumentation of coffee machines
+STATE_TRANSITIONS = metrics.REGISTRY.counter('coffee_state_transitions_total', 'State transitions of coffee machines')
+STATE = metrics.REGISTRY.gauge('coffee_state', 'Current state of coffee machines')
+DEPOSIT_REMAINING = metrics.REGISTRY.gauge('coffee_deposit_remaining', 'Remaining deposit of coffee machines in IOTA')
+DIGESTS_REMAINING = metrics.REGISTRY.gauge('coffee_digests_remaining', 'Remaining multisig digests of coffee machines')
+MESSAGES_DROPPED = metrics.REGISTRY.counter('coffee_messages_dropped_total', 'MQTT commands shed or ignored')
+
+
+# state handling of coffee machine
+class State(Enum):
+    UNINITIALISED = 0
+    INITIALISING = 1
+    INITIALISED = 2
+    FUNDING = 3
+    FUNDED = 4
+    CLOSING = 5
+    CLOSED = 6
+    NO_FUNDS = 7
+    NO_ADDRESSES_LEFT = 8
+    ERROR = 9
+
+
+# states, in which orders of coffee are served (or refused with the reason)
+ORDER_STATES = (State.FUNDED, State.NO_FUNDS, State.NO_ADDRESSES_LEFT, State.ERROR)
+
+# states, in which the active channel is replaced by a funded standby channel (including exhausted channels)
+ROLLOVER_STATES = (State.FUNDED, State.NO_FUNDS, State.NO_ADDRESSES_LEFT)
+
+# states, in which a funded standby channel is not needed anymore and is closed right away
+DISCARD_STANDBY_STATES = (State.UNINITIALISED, State.INITIALISING, State.CLOSING, State.CLOSED)
+
+
+class CoffeeMachine:
+    """Coffee machine paying for each coffee via its own Flash channel.
+
+    A machine without id uses the topics directly below /coffee (e.g. /coffee/make), otherwise its topics are
+    namespaced by its id (e.g. /coffee/<machine_id>/make).
+
+    Each payment publishes a small delta of the channel, whereas full flash objects are only published after
+    opening and closing the channel, every snapshot_interval payments and on request.
+
+    In speculative mode the transfers of the next single and double coffee are prepared and co-signed in the
+    background, so that an order only needs to apply them. Prepared transfers are bound to the channel state they
+    were created for and are discarded as soon as this state changes.
+
+    In aggregation mode coffees are recorded in a persisted ledger and paid with a single transfer as soon as their
+    value reaches settle_value or the oldest of them is settle_interval seconds old. Thereby each settlement instead
+    of each coffee consumes a digest of the channel.
+
+    With rollover enabled, a standby channel is opened and funded in the background as soon as the remaining
+    deposit or digests of the active channel fall to their watermarks. The next order switches to the standby
+    channel (also once the active channel is exhausted), while the old channel is closed in the background.
+
+    With a store, every change of the channels and state is persisted, so that the machine resumes its channels
+    after a restart instead of opening new ones.
+
+    With a planner, the depth and deposit of each new channel are chosen from the demand recorded by the planner
+    instead of using TREE_DEPTH and DEPOSIT.
+
+    With a finalizer, closed channels are finalised in the background (attaching their settlement to the Tangle and
+    tracking its confirmation), so that the machine can open the next channel right away. The progress of each
+    channel is published on /coffee/finalize.
+
+    Updates are published in each of the encodings of the machine, where JSON uses the plain topics and binary
+    encodings (MessagePack, CBOR) the topics suffixed by the encoding (e.g. /coffee/flash/msgpack).
+    """
+
+    def __init__(self, mqtt_client, flash_clients, executor, machine_id=None, snapshot_interval=20,
+                 speculative=False, aggregate=False, settle_value=10 * PRICE_SINGLE_COFFEE, settle_interval=3600,
+                 ledger_dir='.', rollover=False, rollover_deposit=5 * PRICE_SINGLE_COFFEE, rollover_digests=3,
+                 store=None, encodings=('json',), finalizer=None, planner=None):
+        self.machine_id = machine_id
+        self.topic_prefix = TOPIC_ROOT if machine_id is None else '{}/{}'.format(TOPIC_ROOT, machine_id)
+        self.mqtt_client = mqtt_client
+        self.executor = executor
+        self.store = store
+        self.encodings = encodings
+        for encoding in encodings:
+            codec.check(encoding)
+        self.snapshot_interval = int(snapshot_interval)
+        self.logger = logger if machine_id is None else logger.getChild(machine_id)
+
+        self.current_state = State.UNINITIALISED
+        self.channel = ChannelState(flash_clients)
+        self.channel_lock = Lock()
+
+        # transfers signed ahead of orders (value -> (channel key, signed bundles))
+        self.speculator = ThreadPoolExecutor(max_workers=1) if speculative else None
+        self.presigned = {}
+
+        # coffees served, but not yet paid
+        self.ledger = None
+        self.settle_value = int(settle_value)
+        self.settle_interval = float(settle_interval)
+        self.settle_timer = None
+        if aggregate:
+            self.ledger = Ledger(os.path.join(ledger_dir, '{}.ledger'.format(machine_id or 'coffee')))
+
+        # funded channel taking over, once the active channel runs low
+        self.rollover_executor = ThreadPoolExecutor(max_workers=1) if rollover else None
+        self.rollover_deposit = int(rollover_deposit)
+        self.rollover_digests = int(rollover_digests)
+        self.standby = None
+        self.standby_pending = False
+
+        self.planner = planner
+
+        # closed channels, whose settlement is attached in the background (channel id -> progress)
+        self.finalizer = finalizer
+        self.finalizing = {}
+        self.finalizing_lock = Lock()
+
+    @property
+    def flash_clients(self):
+        return self.channel.flash_clients
+
+    @property
+    def available_deposit(self):
+        """Deposit of the machine, which is not yet claimed by unsettled coffees."""
+        unsettled = self.ledger.value if self.ledger else 0
+        return self.channel.deposit[0] - unsettled
+
+    def topic(self, name):
+        return '{}/{}'.format(self.topic_prefix, name)
+
+    def set_state(self, state):
+        self.logger.info('Setting state {}'.format(state.name))
+        self.current_state = state
+        self.persist('state', {'state': state.name})
+        STATE_TRANSITIONS.inc(machine=self.machine_id, state=state.name)
+        STATE.set(state.value, machine=self.machine_id)
+        self.publish_state(self.current_state.name)
+
+    def persist(self, kind, record):
+        if self.store:
+            self.store.append(self.machine_id, kind, record)
+
+    def persist_all(self, records):
+        """Persists records of several kinds (kind -> record) at once."""
+        if self.store:
+            self.store.append_all(self.machine_id, records)
+
+    def recover(self):
+        """Resumes the channels persisted in the store or starts uninitialised."""
+        records = self.store.recover(self.machine_id) if self.store else {}
+        if records.get('settled') and self.ledger is not None:
+            self.ledger.clear(until=records['settled']['until'])
+        for record in records.get('finalizing') or []:
+            self.finalize(self.flash_clients[0].fork(), record)
+
+        state = State[records['state']['state']] if 'state' in records else State.UNINITIALISED
+        if state == State.INITIALISING or not records.get('channel'):
+            self.set_state(State.UNINITIALISED)
+            return
+
+        self.channel.restore(records['channel'])
+        if records.get('standby'):
+            self.standby = ChannelState([client.fork() for client in self.flash_clients])
+            self.standby.restore(records['standby'])
+        self.logger.info('Recovered channel {} at bundle {}'.format(self.channel.channel_ids[0],
+                                                                    self.channel.sequence))
+
+        # publish changes
+        self.publish_flash()
+        self.publish_delta(self.channel.delta())
+        self.publish_channel_ids(channel_ids=self.channel.channel_ids)
+        self.set_state(State.FUNDED if state == State.FUNDING else state)
+
+        # bundles, which were signed but possibly not applied by all Flash servers before the shutdown
+        pending = records.get('pending')
+        if pending and pending['channel_ids'] == self.channel.channel_ids:
+            if pending.get('sequence', self.channel.sequence) < self.channel.sequence:
+                self.logger.info('Pending bundles already applied')
+                self.persist('pending', None)
+            else:
+                self.logger.info('Applying pending bundles')
+                self.execute(lambda: self.apply_bundles(pending['bundles'], settled=pending.get('settled')))
+
+        # coffees served before the shutdown are settled once due (requested via MQTT, which is connected by now)
+        if self.ledger:
+            self.schedule_settlement()
+        self.speculate()
+
+    def publish(self, name, payload):
+        """Publishes a retained update in each of the encodings of the machine."""
+        for encoding in self.encodings:
+            self.mqtt_client.publish(topic=codec.topic(self.topic(name), encoding),
+                                     payload=codec.encode(payload, encoding), retain=True)
+
+    def publish_state(self, state):
+        self.publish('state', {'state': state})
+
+    def publish_flash(self):
+        self.publish('flash', {'flash': self.channel.flash_objects})
+
+    def publish_delta(self, delta):
+        DEPOSIT_REMAINING.set(delta['deposit'][0], machine=self.machine_id)
+        DIGESTS_REMAINING.set(delta['digests'], machine=self.machine_id)
+        self.publish('flash/delta', delta)
+        self.publish_summary()
+
+    def publish_summary(self):
+        """Publishes the few figures shown by dashboards, so that they need not parse the flash objects.
+
+        The deposit excludes coffees, which were served but not yet settled, so that it agrees with the coffees.
+        """
+        self.publish('flash/summary', {'deposit': self.available_deposit,
+                                       'digests': self.channel.digests,
+                                       'coffees': self.channel.coffees,
+                                       'channel_id': self.channel.channel_ids[0]})
+
+    def publish_channel_ids(self, channel_ids):
+        self.publish('channel_ids', {'channel_ids': channel_ids})
+
+    def publish_transactions(self, bundle_hashes, reason):
+        self.publish('transactions', {'bundle_hashes': bundle_hashes, 'reason': reason})
+
+    def fan_out(self, call, flash_clients=None):
+        """Executes call(idx, client) for all Flash clients in parallel and returns results in order of clients."""
+        flash_clients = flash_clients or self.flash_clients
+        return list(self.executor.map(call, range(len(flash_clients)), flash_clients))
+
+    def init_coffee(self):
+        self.logger.info('Init coffee')
+        self.set_state(State.INITIALISING)
+
+        delta = self.open_channel(self.channel)
+
+        # publish changes
+        self.set_state(State.INITIALISED)
+        self.publish_flash()
+        self.publish_delta(delta)
+        self.publish_channel_ids(channel_ids=self.channel.channel_ids)
+
+    def open_channel(self, channel):
+        """Initialises a channel between all Flash servers and returns its initial delta."""
+        flash_clients = channel.flash_clients
+        signers_count = len(flash_clients)
+        depth, deposit = self.planner.plan(self.machine_id) if self.planner else (TREE_DEPTH, DEPOSIT[0])
+        start = time.monotonic()
+        flash_objects = self.fan_out(
+            lambda idx, client: client.init(userIndex=idx, security=SECURITY, depth=depth, signersCount=signers_count,
+                                            balance=deposit * signers_count, deposit=[deposit] * signers_count),
+            flash_clients)
+
+        if channel is self.channel:
+            self.publish_channel_ids(channel_ids=channel.channel_ids)
+
+        self.logger.info('Generating multisignature addresses')
+        all_digests = [fo['partialDigests'] for fo in flash_objects]
+        self.fan_out(lambda idx, client: client.multisignature(allDigests=all_digests), flash_clients)
+
+        self.logger.info('Fetching settlement addresses')
+        address_responses = self.fan_out(lambda idx, client: client.settlement_address(), flash_clients)
+        channel.settlement_addresses[:] = [r['address'] for r in address_responses]
+
+        self.logger.info('Setting settlement addresses')
+        flash_objects = self.fan_out(
+            lambda idx, client: client.settlement(settlementAddresses=channel.settlement_addresses), flash_clients)
+        if self.planner:
+            self.planner.record_init(depth, time.monotonic() - start)
+        with self.channel_lock:
+            self.presigned.clear()
+            delta = channel.reset(flash_objects)
+        if channel is self.channel:
+            self.persist('channel', channel.record())
+        return delta
+
+    def apply_and_sign(self, bundles):
+        self.apply_bundles(self.sign_bundles(bundles))
+
+    def sign_bundles(self, bundles, channel=None):
+        # sign bundles (sequentially, since each party signs the bundles of its predecessor)
+        self.logger.info('Signing bundles')
+        for client in (channel or self.channel).flash_clients:
+            bundles = client.sign(bundles=bundles)
+        return bundles
+
+    def apply_bundles(self, bundles, channel=None, coffees=0, settled=None):
+        """Applies signed bundles to a channel (the active one by default).
+
+        The bundles are persisted as pending with the sequence of the channel they are applied to, so that they are
+        only applied again on recovery, if the persisted channel does not include them yet. Bundles of a settlement
+        pass the time of the last coffee they pay for as settled, which is persisted together with the channel, so
+        that these coffees are removed from the ledger (also on recovery) and never paid twice.
+        """
+        self.logger.info('Applying bundles')
+        channel = channel or self.channel
+        is_active = channel is self.channel
+        if is_active:
+            self.persist('pending', {'channel_ids': channel.channel_ids, 'sequence': channel.sequence,
+                                     'bundles': bundles, 'settled': settled})
+        flash_objects = self.fan_out(lambda idx, client: client.apply(signedBundles=bundles), channel.flash_clients)
+        with self.channel_lock:
+            delta = channel.update(flash_objects, bundle_hashes=[bundle[0]['bundle'] for bundle in bundles],
+                                   coffees=coffees)
+            self.presigned.clear()
+
+        # publish changes
+        if is_active:
+            records = {'channel': channel.record(), 'pending': None}
+            if settled is not None:
+                records['settled'] = {'until': settled}
+            self.persist_all(records)
+            if settled is not None and self.ledger is not None:
+                self.ledger.clear(until=settled)
+            self.publish_delta(delta)
+            if delta['sequence'] % self.snapshot_interval == 0:
+                self.publish_flash()
+
+    def fund(self):
+        self.logger.info('Funding coffee machine')
+        self.set_state(State.FUNDING)
+
+        try:
+            transactions = self.fan_out(lambda idx, client: client.fund())
+            self.publish_transactions(bundle_hashes=[tx[0]['bundle'] for tx in transactions], reason='Funding')
+        except:
+            self.logger.exception('Error while funding channel')
+
+        self.set_state(State.FUNDED)
+        self.speculate()
+
+    def close_and_finalyse(self):
+        self.settle()
+
+        self.logger.info('Closing channel')
+        self.close_channel(self.channel)
+        self.publish_flash()
+        self.finalize_channel(self.channel)
+
+        standby, self.standby = self.standby, None
+        if standby:
+            self.persist('standby', None)
+            self.close_channel(standby)
+            self.finalize_channel(standby)
+
+        self.set_state(State.CLOSED)
+
+    def close_channel(self, channel):
+        closing_bundles = channel.flash_clients[0].close()
+        self.apply_bundles(self.sign_bundles(closing_bundles, channel), channel)
+
+    def finalize_channel(self, channel):
+        """Hands a closed channel over to the finalizer (on a client of its own, since the channel is replaced)."""
+        client = channel.flash_clients[0].fork()
+        self.finalize(client, {'channel_id': channel.channel_ids[0]})
+
+    def finalize(self, client, record):
+        if self.finalizer is None:
+            return
+        client.channel_id = record['channel_id']
+        self.finalizer.submit(client, record, progress=self.update_finalizing)
+
+    def update_finalizing(self, record):
+        """Persists and publishes the progress of finalising a channel."""
+        self.logger.info('Finalising channel {}: {}'.format(record['channel_id'], record['status']))
+        with self.finalizing_lock:
+            self.finalizing[record['channel_id']] = record
+            if self.finalizer.done(record):
+                del self.finalizing[record['channel_id']]
+            self.persist('finalizing', list(self.finalizing.values()))
+        if record['status'] == 'attached':
+            self.publish_transactions(bundle_hashes=record['bundle_hashes'], reason='Finalising')
+        self.publish('finalize', record)
+
+    def make_coffee(self, mode):
+        self.logger.info('Making coffee {}'.format(mode))
+        self.roll_over()
+
+        # compute value
+        num_coffees = 1 if mode == 'single' else 2
+        value = PRICE_SINGLE_COFFEE * num_coffees
+
+        # check state of deposits (including coffees, which have not been settled yet)
+        if self.available_deposit < value:
+            time.sleep(2)
+            self.set_state(State.NO_FUNDS)
+            return
+
+        # check number of transactions left (at least one must be left for closing the channel)
+        if self.channel.digests <= 1:
+            time.sleep(2)
+            self.set_state(State.NO_ADDRESSES_LEFT)
+            return
+
+        if self.ledger is not None:
+            self.accrue(value=value, mode=mode)
+        else:
+            self.logger.info('Paying {} IOTA for coffee'.format(value))
+            self.pay_for_coffee(value=value, coffees=num_coffees)
+            self.publish_state('Payed {} MIOTA for {} coffee'.format(value / 1e6, mode))
+        if self.planner:
+            self.planner.record_order(self.machine_id, num_coffees)
+        self.roll_over()
+
+    def accrue(self, value, mode):
+        self.ledger.add(value=value, mode=mode)
+        self.channel.coffees += value // PRICE_SINGLE_COFFEE
+        self.publish_state('Served {} coffee ({} MIOTA unsettled)'.format(mode, self.ledger.value / 1e6))
+        self.publish_summary()
+
+        if self.ledger.value >= self.settle_value or time.time() - self.ledger.since >= self.settle_interval:
+            self.settle()
+        elif len(self.ledger) == 1:
+            self.schedule_settlement()
+
+    def schedule_settlement(self):
+        """Requests a settlement via MQTT once the oldest unsettled coffee reaches settle_interval."""
+        delay = max(0, self.ledger.since + self.settle_interval - time.time())
+        self.settle_timer = Timer(delay, self.mqtt_client.publish, kwargs={'topic': self.topic('settle')})
+        self.settle_timer.daemon = True
+        self.settle_timer.start()
+
+    def settle(self):
+        if not self.ledger:
+            return
+        if self.settle_timer:
+            self.settle_timer.cancel()
+
+        value, num_coffees, until = self.ledger.value, len(self.ledger), self.ledger.entries[-1]['time']
+        self.logger.info('Paying {} IOTA for {} coffees'.format(value, num_coffees))
+        self.pay_for_coffee(value=value, settled=until)
+        self.publish_state('Payed {} MIOTA for {} coffees'.format(value / 1e6, num_coffees))
+
+    def pay_for_coffee(self, value, coffees=0, settled=None):
+        bundles = self.take_presigned(value)
+        if bundles is None:
+            bundles = self.sign_bundles(self.compose_transfer(value))
+        self.apply_bundles(bundles, coffees=coffees, settled=settled)
+        self.speculate()
+
+    def compose_transfer(self, value, channel=None):
+        channel = channel or self.channel
+        transfers = [{'value': value, 'address': channel.settlement_addresses[1]}]
+        return channel.flash_clients[0].transfer(transfers=transfers)
+
+    def channel_key(self):
+        """Identifies the state of the channel, for which transfers can be prepared."""
+        return self.flash_clients[0].channel_id, self.channel.sequence
+
+    def speculate(self):
+        if self.speculator and self.current_state == State.FUNDED:
+            self.speculator.submit(self.prepare_transfers)
+
+    def prepare_transfers(self):
+        """Composes and signs the transfers of the next single and double coffee."""
+        channel, key = self.channel, self.channel_key()
+        try:
+            for num_coffees in (1, 2):
+                value = PRICE_SINGLE_COFFEE * num_coffees
+                if channel.deposit[0] < value or channel.digests <= 1:
+                    continue
+                bundles = self.sign_bundles(self.compose_transfer(value, channel), channel)
+                with self.channel_lock:
+                    if key != self.channel_key():
+                        self.logger.info('Discarding stale transfers')
+                        return
+                    self.presigned[value] = (key, bundles)
+        except:
+            self.logger.exception('Error while preparing transfers')
+
+    def take_presigned(self, value):
+        with self.channel_lock:
+            key, bundles = self.presigned.pop(value, (None, None))
+            if key is not None and key == self.channel_key():
+                self.logger.info('Using prepared transfer of {} IOTA'.format(value))
+                return bundles
+            return None
+
+    def roll_over(self):
+        """Prepares a standby channel once the active channel reaches a watermark and switches to it when ready."""
+        if not self.rollover_executor or self.current_state not in ROLLOVER_STATES:
+            return
+        if self.available_deposit > self.rollover_deposit and self.channel.digests > self.rollover_digests:
+            return
+
+        if self.standby:
+            self.switch_channel()
+        elif not self.standby_pending:
+            self.standby_pending = True
+            self.rollover_executor.submit(self.prepare_standby)
+
+    def prepare_standby(self):
+        self.logger.info('Preparing standby channel')
+        try:
+            channel = ChannelState([client.fork() for client in self.flash_clients])
+            self.open_channel(channel)
+            transactions = self.fan_out(lambda idx, client: client.fund(), channel.flash_clients)
+            self.publish_transactions(bundle_hashes=[tx[0]['bundle'] for tx in transactions],
+                                      reason='Funding standby')
+            if self.current_state in DISCARD_STANDBY_STATES:
+                self.close_rolled_over(channel)
+                return
+            self.standby = channel
+            self.persist('standby', channel.record())
+            self.logger.info('Standby channel {} ready'.format(channel.channel_ids[0]))
+        except:
+            self.logger.exception('Error while preparing standby channel')
+        finally:
+            self.standby_pending = False
+
+    def switch_channel(self):
+        # unsettled coffees are paid via the channel they were served with
+        self.settle()
+
+        with self.channel_lock:
+            channel, self.channel, self.standby = self.channel, self.standby, None
+            self.presigned.clear()
+        self.persist('channel', self.channel.record())
+        self.persist('standby', None)
+        self.logger.info('Rolled over from channel {} to {}'.format(channel.channel_ids[0],
+                                                                     self.channel.channel_ids[0]))
+
+        # publish changes
+        self.publish_flash()
+        self.publish_delta(self.channel.delta())
+        self.publish_channel_ids(channel_ids=self.channel.channel_ids)
+        self.rollover_executor.submit(self.close_rolled_over, channel)
+        if self.current_state != State.FUNDED:
+            self.set_state(State.FUNDED)
+        self.speculate()
+
+    def close_rolled_over(self, channel):
+        self.logger.info('Closing channel {}'.format(channel.channel_ids[0]))
+        try:
+            self.close_channel(channel)
+            self.finalize_channel(channel)
+        except:
+            self.logger.exception('Error while closing channel {}'.format(channel.channel_ids[0]))
+
+    def execute(self, operation, *args):
+        try:
+            operation(*args)
+        except:
+            self.logger.exception('Error while handling message')
+            time.sleep(1)
+            self.set_state(State.ERROR)
+
+    def execute_command(self, command, payload):
+        # orders, which were overtaken by a command of higher priority (e.g. close), are not served
+        if command == 'make' and self.current_state not in ORDER_STATES:
+            self.logger.info('Ignoring order in state {}'.format(self.current_state.name))
+            MESSAGES_DROPPED.inc(machine=self.machine_id, command=command)
+            return
+
+        if command == 'make':
+            self.execute(self.make_coffee, payload.decode('utf-8'))
+        if command == 'init':
+            self.execute(self.init_coffee)
+        if command == 'fund':
+            self.execute(self.fund)
+        if command == 'close':
+            self.execute(self.close_and_finalyse)
+        if command == 'snapshot':
+            self.execute(self.publish_flash)
+        if command == 'settle':
+            self.execute(self.settle)
+
+
+class ChannelManager:
+    """Hosts coffee machines, each with its own Flash channel, in a single process.
+
+    All machines share one MQTT connection and one pool of connections and token per Flash server. Without machine
+    ids a single machine using the plain /coffee topics is served.
+
+    Commands are subscribed with QoS 1 on a persistent session, so that the broker keeps commands published while
+    the client is offline and delivers them after reconnecting. Since paho acknowledges a command before it is passed
+    to on_message, commands still queued when the client crashes are lost. Each machine serves its queue of commands
+    by priority in its own thread.
+    """
+
+    def __init__(self, mqtt_client, flash_configs, http_config, machine_ids=None, queue_size=16, **machine_options):
+        self.mqtt_client = mqtt_client
+        machine_ids = machine_ids or [None]
+        self.commands = {machine_id: ThreadCommandQueue(maxsize=int(queue_size)) for machine_id in machine_ids}
+
+        # sessions are shared by all machines, so size pools and workers by the number of machines
+        pool_size = max(int(http_config['pool_size']), len(machine_ids))
+        sessions = [create_session(pool_size=pool_size, retries=http_config['retries'],
+                                   backoff=http_config['backoff']) for _ in flash_configs]
+        tokens = [Token(lifetime=http_config['token_lifetime'], refresh_margin=http_config['token_refresh'])
+                  for _ in flash_configs]
+        self.executor = ThreadPoolExecutor(max_workers=len(flash_configs) * len(machine_ids))
+
+        self.machines = {}
+        for machine_id in machine_ids:
+            flash_clients = [FlashClient(**flash_config, **http_config, session=session, token=token)
+                             for flash_config, session, token in zip(flash_configs, sessions, tokens)]
+            self.machines[machine_id] = CoffeeMachine(mqtt_client=mqtt_client, flash_clients=flash_clients,
+                                                      executor=self.executor, machine_id=machine_id,
+                                                      **machine_options)
+
+    def authenticate(self, timeout=0):
+        """Authenticates all Flash clients in parallel, waiting up to timeout seconds for servers to become ready."""
+        clients = [c for machine in self.machines.values() for c in machine.flash_clients]
+        list(self.executor.map(lambda client: wait_for(client.authenticate, name='Flash server ' + client.url,
+                                                       timeout=timeout, retry_on=NOT_READY_ERRORS), clients))
+
+    def subscriptions(self):
+        return [(machine.topic(command), 1) for machine in self.machines.values() for command in COMMANDS]
+
+    def route(self, topic):
+        """Returns the machine and the command addressed by a topic (or None for a machine not managed here)."""
+        parts = topic[len(TOPIC_ROOT) + 1:].split('/')
+        machine_id = parts[0] if len(parts) > 1 else None
+        if machine_id not in self.machines:
+            return None
+        return self.machines[machine_id], parts[-1]
+
+    def drop_unknown(self, client, topic):
+        """Drops a command of a machine not managed here and unsubscribes its topic.
+
+        The persistent session keeps the subscriptions of machines, which were removed from the config, so that the
+        broker still delivers their commands.
+        """
+        parts = topic[len(TOPIC_ROOT) + 1:].split('/')
+        logger.warning('Dropping command of unknown machine on {}'.format(topic))
+        MESSAGES_DROPPED.inc(machine=parts[0] if len(parts) > 1 else None, command=parts[-1])
+        client.unsubscribe(topic)
+
+    def on_connect(self, client, userdata, flags, rc):
+        client.subscribe(self.subscriptions())
+
+    def on_message(self, client, userdata, msg):
+        route = self.route(msg.topic)
+        if route is None:
+            self.drop_unknown(client, msg.topic)
+            return
+        machine, command = route
+        enqueue(self.commands[machine.machine_id], machine, command, msg.payload)
+
+    def start(self):
+        """Starts serving the queued commands of each machine in its own thread."""
+        for machine_id, machine in self.machines.items():
+            Thread(target=self.serve, args=(machine, self.commands[machine_id]), daemon=True).start()
+
+    @staticmethod
+    def serve(machine, commands):
+        while True:
+            item = commands.get()
+            commands.running = item
+            machine.execute_command(*item)
+            commands.running = None
+
+
+def enqueue(commands, machine, command, payload):
+    """Queues a command of a machine and returns the command shed by a full queue (if any)."""
+    dropped = commands.offer((command, payload))
+    if dropped:
+        machine.logger.info('Command queue full, dropping {}'.format(dropped[0]))
+        MESSAGES_DROPPED.inc(machine=machine.machine_id, command=dropped[0])
+    return dropped
+
+
+def run_asyncio(manager, queue_size):
+    """Serves MQTT commands from an asyncio event loop instead of spawning a thread per message.
+
+    The MQTT socket is driven by the event loop and commands are put into a bounded priority queue per machine.
+    Commands of a machine are executed one after another in the default executor of the loop.
+    """
+    loop = asyncio.get_event_loop()
+    mqtt_client = manager.mqtt_client
+    queues = {machine_id: CommandQueue(maxsize=queue_size) for machine_id in manager.machines}
+    reader = {'fd': None}
+
+    def start_reading():
+        if reader['fd'] is None and mqtt_client.socket():
+            reader['fd'] = mqtt_client.socket().fileno()
+            loop.add_reader(reader['fd'], read_socket)
+
+    def stop_reading():
+        if reader['fd'] is not None:
+            loop.remove_reader(reader['fd'])
+            reader['fd'] = None
+
+    def read_socket():
+        if mqtt_client.loop_read() != mqtt.MQTT_ERR_SUCCESS:
+            logger.info('MQTT connection lost')
+            stop_reading()
+            return
+        if mqtt_client.want_write():
+            mqtt_client.loop_write()
+
+    def on_message_async(client, userdata, msg):
+        route = manager.route(msg.topic)
+        if route is None:
+            manager.drop_unknown(client, msg.topic)
+            return
+        machine, command = route
+        enqueue(queues[machine.machine_id], machine, command, msg.payload)
+
+    async def process_commands(machine):
+        commands = queues[machine.machine_id]
+        while True:
+            item = await commands.get()
+            commands.running = item
+            await loop.run_in_executor(None, machine.execute_command, *item)
+            commands.running = None
+
+    async def maintain_connection():
+        while True:
+            if mqtt_client.socket() is None:
+                try:
+                    mqtt_client.reconnect()
+                    start_reading()
+                except OSError:
+                    logger.exception('Error while reconnecting MQTT client')
+            else:
+                mqtt_client.loop_misc()
+                if mqtt_client.want_write():
+                    mqtt_client.loop_write()
+            await asyncio.sleep(1)
+
+    mqtt_client.on_message = on_message_async
+    start_reading()
+    tasks = [process_commands(machine) for machine in manager.machines.values()]
+    loop.run_until_complete(asyncio.gather(maintain_connection(), *tasks))
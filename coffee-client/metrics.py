@@ -0,0 +1,152 @@
+import json
+import logging
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Lock, Thread
+
+logger = logging.getLogger('coffeemachine')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float('inf'))
+
+
+class Metric:
+    """Metric with values per set of labels, rendered in the Prometheus text format."""
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted((k, '' if v is None else str(v)) for k, v in labels.items()))
+
+    @staticmethod
+    def _format_labels(key, **extra):
+        labels = list(key) + sorted(extra.items())
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return ['{}{} {}'.format(self.name, self._format_labels(key), value)]
+
+    def snapshot(self):
+        with self.lock:
+            return [{'labels': dict(key), 'value': value} for key, value in self.values.items()]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            observations = self.values.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0})
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    observations['buckets'][idx] += 1
+            observations['sum'] += value
+            observations['count'] += 1
+
+    def _render_value(self, key, value):
+        lines = ['{}_bucket{} {}'.format(self.name, self._format_labels(key, le='+Inf' if bound == float('inf')
+                                                                          else str(bound)), count)
+                 for bound, count in zip(self.buckets, value['buckets'])]
+        lines.append('{}_sum{} {}'.format(self.name, self._format_labels(key), value['sum']))
+        lines.append('{}_count{} {}'.format(self.name, self._format_labels(key), value['count']))
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return [{'labels': dict(key), 'value': {'sum': value['sum'], 'count': value['count']}}
+                    for key, value in self.values.items()]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation):
+        return self._register(Counter(name, documentation))
+
+    def gauge(self, name, documentation):
+        return self._register(Gauge(name, documentation))
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, buckets=buckets))
+
+    def render(self):
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+
+REGISTRY = Registry()
+
+
+def serve(port, registry=REGISTRY):
+    """Exposes the metrics on http://<host>:<port>/metrics."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(('', int(port)), MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    logger.info('Serving metrics on port {}'.format(server.server_port))
+    return server
+
+
+def publish(mqtt_client, topic, interval, registry=REGISTRY):
+    """Publishes the metrics as JSON on an MQTT topic every interval seconds."""
+
+    def publish_forever():
+        while True:
+            time.sleep(interval)
+            mqtt_client.publish(topic=topic, payload=json.dumps(registry.snapshot()))
+
+    Thread(target=publish_forever, daemon=True).start()
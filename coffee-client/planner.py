@@ -0,0 +1,184 @@
+"""Planner of the size of Flash channels from the observed demand of coffee machines.
+
+Prints the modelled options of tree depth and deposit for each machine recorded in a demand file, e.g.
+
+    python planner.py --demand demand.json --machine kitchen
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from threading import Lock
+
+import settings
+from machine import DEPOSIT, PRICE_SINGLE_COFFEE, TREE_DEPTH
+
+logger = logging.getLogger('coffeemachine')
+
+DAY = 24 * 3600
+
+# days of recorded demand and the on-chain operations of each channel (funding by both parties and settlement)
+HISTORY_DAYS = 28
+ONCHAIN_OPERATIONS = 3
+
+# initialisation time per digest until inits have been observed, weight of new observations and interval of saving
+SECONDS_PER_DIGEST = 1.0
+INIT_WEIGHT = 0.3
+SAVE_INTERVAL = 60
+
+
+class ChannelPlanner:
+    """Chooses the depth and deposit of new channels, which minimise on-chain operations and init time.
+
+    Orders are counted per machine and day for HISTORY_DAYS, from which the demand per day is forecast. Each option
+    of depth and deposit is modelled by the number of payments it allows (2 ** depth digests, one of which is left
+    for closing, and the deposit in single coffees), the resulting lifetime of a channel and the on-chain operations
+    per day of replacing channels, as well as its init time (proportional to its digests, learned from observed
+    inits). Options initialising slower than max_init_seconds are not chosen and lifetimes are capped at
+    max_channel_days, so that deeper trees or larger deposits than needed do not win. Of the options with the
+    fewest on-chain operations per day the fastest to initialise with the smallest deposit is chosen.
+
+    Without recorded demand the default depth and deposit are used. Demand and init times are saved to path.
+    """
+
+    def __init__(self, path=None, depths=(3, 4, 5, 6), deposits=(5000000, 10000000, 20000000), max_init_seconds=120,
+                 max_channel_days=7, aggregate=False, settle_value=10 * PRICE_SINGLE_COFFEE):
+        self.path = path
+        self.depths = [int(depth) for depth in depths]
+        self.deposits = [int(deposit) for deposit in deposits]
+        self.max_init_seconds = float(max_init_seconds)
+        self.max_channel_days = float(max_channel_days)
+        self.aggregate = aggregate
+        self.settle_value = int(settle_value)
+        self.lock = Lock()
+        self.demand = {}
+        self.seconds_per_digest = SECONDS_PER_DIGEST
+        self.saved = 0
+        if path and os.path.exists(path):
+            with open(path) as demand_file:
+                state = json.load(demand_file)
+            self.demand = state.get('demand', {})
+            self.seconds_per_digest = state.get('seconds_per_digest', SECONDS_PER_DIGEST)
+
+    def record_order(self, machine_id, coffees, now=None):
+        """Counts an order of a number of coffees."""
+        now = time.time() if now is None else now
+        day = str(int(now // DAY))
+        with self.lock:
+            days = self.demand.setdefault(machine_id or '', {})
+            orders, cups = days.get(day, (0, 0))
+            days[day] = (orders + 1, cups + coffees)
+            for old_day in [d for d in days if int(d) <= int(day) - HISTORY_DAYS]:
+                del days[old_day]
+        if now - self.saved >= SAVE_INTERVAL:
+            self.save(now)
+
+    def record_init(self, depth, seconds):
+        """Learns the init time per digest from the duration of initialising a channel."""
+        with self.lock:
+            self.seconds_per_digest = INIT_WEIGHT * seconds / 2 ** depth + (1 - INIT_WEIGHT) * self.seconds_per_digest
+        self.save()
+
+    def forecast(self, machine_id, now=None):
+        """Returns the forecast orders and coffees per day of a machine (or None without recorded demand)."""
+        now = time.time() if now is None else now
+        with self.lock:
+            days = dict(self.demand.get(machine_id or '', {}))
+        if not days:
+            return None
+        # average over the recorded days up to now, counting days without orders
+        span = max(1.0, now / DAY - min(int(day) for day in days))
+        return {'orders': sum(orders for orders, _ in days.values()) / span,
+                'coffees': sum(cups for _, cups in days.values()) / span}
+
+    def model(self, depth, deposit, demand):
+        """Returns the modelled costs of a channel of depth and deposit for a demand per day."""
+        payments = 2 ** depth - 1
+        coffees = deposit // PRICE_SINGLE_COFFEE
+        if self.aggregate:
+            payments_per_day = demand['coffees'] * PRICE_SINGLE_COFFEE / self.settle_value
+        else:
+            payments_per_day = demand['orders']
+        days = min(payments / payments_per_day if payments_per_day else float('inf'),
+                   coffees / demand['coffees'] if demand['coffees'] else float('inf'),
+                   self.max_channel_days)
+        return {'depth': depth,
+                'deposit': deposit,
+                'digests': 2 ** depth,
+                'init_seconds': self.seconds_per_digest * 2 ** depth,
+                'channel_days': days,
+                'onchain_per_day': ONCHAIN_OPERATIONS / days}
+
+    def options(self, machine_id, now=None):
+        demand = self.forecast(machine_id, now)
+        if demand is None:
+            return demand, []
+        return demand, [self.model(depth, deposit, demand) for depth in self.depths for deposit in self.deposits]
+
+    def plan(self, machine_id, now=None):
+        """Returns the depth and deposit of the next channel of a machine."""
+        demand, options = self.options(machine_id, now)
+        feasible = [o for o in options if o['init_seconds'] <= self.max_init_seconds]
+        if not feasible:
+            return TREE_DEPTH, DEPOSIT[0]
+        best = min(feasible, key=lambda o: (round(o['onchain_per_day'], 6), o['init_seconds'], o['deposit']))
+        logger.info('Planned channel of depth {} with deposit {} for {:.1f} orders per day'.format(
+            best['depth'], best['deposit'], demand['orders']))
+        return best['depth'], best['deposit']
+
+    def save(self, now=None):
+        if not self.path:
+            return
+        with self.lock:
+            state = json.dumps({'demand': self.demand, 'seconds_per_digest': self.seconds_per_digest})
+            self.saved = time.time() if now is None else now
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as demand_file:
+            demand_file.write(state)
+        os.replace(tmp_path, self.path)
+
+
+def from_config(config):
+    """Creates a planner from the sections PLANNER and CLIENT of the config."""
+    planner_config = settings.section(config, 'PLANNER')
+    client_config = settings.section(config, 'CLIENT')
+    return ChannelPlanner(path=planner_config['demand'],
+                          depths=planner_config['depths'].split(','),
+                          deposits=planner_config['deposits'].split(','),
+                          max_init_seconds=planner_config['max_init_seconds'],
+                          max_channel_days=planner_config['max_channel_days'],
+                          aggregate=settings.boolean(client_config['aggregate']),
+                          settle_value=client_config['settle_value'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--demand', default=None, help='demand file (default: demand of section PLANNER)')
+    parser.add_argument('--machine', action='append', default=None, help='machine id (default: all machines)')
+    args = parser.parse_args()
+
+    config = settings.read_config()
+    if args.demand:
+        config['PLANNER']['demand'] = args.demand
+    planner = from_config(config)
+
+    print('Init time per digest: {:.2f}s'.format(planner.seconds_per_digest))
+    for machine_id in args.machine or sorted(planner.demand):
+        demand, options = planner.options(machine_id)
+        if demand is None:
+            print('\nMachine {}: no recorded demand'.format(machine_id or '<default>'))
+            continue
+        depth, deposit = planner.plan(machine_id)
+        print('\nMachine {}: {:.1f} orders ({:.1f} coffees) per day'.format(machine_id or '<default>',
+                                                                          demand['orders'], demand['coffees']))
+        print('  depth  deposit  digests  init time  channel days  on-chain/day')
+        for option in options:
+            chosen = '*' if (option['depth'], option['deposit']) == (depth, deposit) else ' '
+            print('{} {:5} {:8} {:8} {:9.1f}s {:13.2f} {:13.3f}'.format(
+                chosen, option['depth'], option['deposit'], option['digests'], option['init_seconds'],
+                option['channel_days'], option['onchain_per_day']))
+
+
+if __name__ == '__main__':
+    main()
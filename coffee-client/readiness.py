@@ -0,0 +1,23 @@
+import logging
+import time
+
+logger = logging.getLogger('coffeemachine')
+
+
+def wait_for(operation, name, timeout, retry_on=(OSError,), backoff=0.1, max_backoff=5.0):
+    """Calls operation until it succeeds, backing off exponentially while it raises one of retry_on.
+
+    Used at startup instead of a fixed delay, so that the client starts as soon as its dependencies are ready.
+    Gives up and re-raises the last error after timeout seconds.
+    """
+    deadline = time.monotonic() + float(timeout)
+    delay = backoff
+    while True:
+        try:
+            return operation()
+        except retry_on as e:
+            if time.monotonic() + delay > deadline:
+                raise
+            logger.info('Waiting for {} ({})'.format(name, e.__class__.__name__))
+        time.sleep(delay)
+        delay = min(delay * 2, max_backoff)
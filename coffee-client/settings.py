@@ -0,0 +1,19 @@
+import configparser
+import os
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini')
+
+
+def read_config(path=CONFIG_PATH):
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
+def section(config, name):
+    """Returns the values of a config section, each overridable by an environment variable (e.g. MQTT_HOST)."""
+    return {k: os.getenv(name + '_' + k.upper(), v) for k, v in dict(config[name]).items()}
+
+
+def boolean(value):
+    return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
@@ -0,0 +1,247 @@
+"""Load simulator of a fleet of coffee machines against local fake Flash servers and an MQTT broker.
+
+Starts N virtual coffee machines (served like by client.py, sharing one MQTT connection or with one connection per
+machine), opens and funds their channels and orders coffees via MQTT following a Poisson process or a morning rush
+(whose rate peaks at --peak times the base rate). Reports for each number of machines the throughput of coffees,
+the queueing delay of orders, dropped and refused orders and the latency of calls within the Flash servers, which
+process --concurrency calls at once, e.g.
+
+    python simulator.py --machines 1 5 10 20 --rate 0.5 --duration 30 --pattern rush --concurrency 1
+
+With --broker the orders are sent via an external broker (e.g. the one of Home Assistant) instead of a fake one.
+"""
+import argparse
+import json
+import logging
+import math
+import random
+import tempfile
+import time
+from threading import Lock
+
+import paho.mqtt.client as mqtt
+
+import settings
+from benchmark import percentile
+from fake_broker import FakeBroker
+from fake_flash import FakeFlashServer
+from machine import ChannelManager, State, enqueue
+
+ARRIVAL_PATTERNS = ['poisson', 'rush']
+
+
+def arrivals(pattern, rate, duration, peak=4.0, rng=random):
+    """Returns the times of orders within duration seconds at rate orders per second.
+
+    The morning rush raises the rate up to peak times the base rate around 30% of the duration.
+    """
+    def rate_at(t):
+        if pattern == 'rush':
+            return rate * (1 + (peak - 1) * math.exp(-0.5 * ((t / duration - 0.3) / 0.1) ** 2))
+        return rate
+
+    # thinning of a Poisson process at the maximal rate
+    max_rate = rate * peak if pattern == 'rush' else rate
+    times, t = [], 0.0
+    while True:
+        t += rng.expovariate(max_rate)
+        if t >= duration:
+            return times
+        if rng.random() < rate_at(t) / max_rate:
+            times.append(t)
+
+
+class Order(bytes):
+    """Payload of a command, stamped with the time it was received from the broker."""
+    received = None
+
+
+class Stats:
+    def __init__(self):
+        self.lock = Lock()
+        self.orders = 0
+        self.served = 0
+        self.refused = 0
+        self.dropped = 0
+        self.queue_delays = []
+        self.service_times = []
+
+    def record(self, command, payload, started, state):
+        with self.lock:
+            if command != 'make':
+                return
+            self.queue_delays.append(started - payload.received)
+            self.service_times.append(time.monotonic() - started)
+            if state == State.FUNDED:
+                self.served += 1
+            else:
+                self.refused += 1
+
+
+class SimulatedManager(ChannelManager):
+    """Channel manager recording the queueing delay, service time and outcome of each command."""
+
+    def __init__(self, stats, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = stats
+
+    def on_message(self, client, userdata, msg):
+        route = self.route(msg.topic)
+        if route is None:
+            self.drop_unknown(client, msg.topic)
+            return
+        machine, command = route
+        payload = Order(msg.payload)
+        payload.received = time.monotonic()
+        if enqueue(self.commands[machine.machine_id], machine, command, payload):
+            with self.stats.lock:
+                self.stats.dropped += 1
+
+    def serve(self, machine, commands):
+        while True:
+            item = commands.get()
+            commands.running = item
+            started = time.monotonic()
+            machine.execute_command(*item)
+            self.stats.record(item[0], item[1], started, machine.current_state)
+            commands.running = None
+
+    def idle(self):
+        return all(not commands.qsize() and commands.running is None for commands in self.commands.values())
+
+
+def connect(client, address, credentials):
+    if credentials:
+        client.username_pw_set(*credentials)
+    client.connect(*address)
+    client.loop_start()
+    return client
+
+
+def wait_until(condition, timeout, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def run(num_machines, args):
+    servers = [FakeFlashServer(latency=args.latency, concurrency=args.concurrency).start() for _ in range(2)]
+    broker = None if args.broker else FakeBroker().start()
+    address = (args.broker.split(':')[0], int(args.broker.split(':')[1])) if args.broker else broker.address
+    credentials = (args.username, args.password) if args.username else None
+
+    flash_configs = [{'url': server.url, 'username': 'user', 'password': 'password'} for server in servers]
+    http_config = settings.section(settings.read_config(), 'HTTP')
+    machine_ids = ['sim{}'.format(idx) for idx in range(num_machines)]
+    groups = [[machine_id] for machine_id in machine_ids] if args.connection_per_machine else [machine_ids]
+
+    stats = Stats()
+    managers, clients = [], []
+    for idx, group in enumerate(groups):
+        client = mqtt.Client(client_id='simulator-machines-{}'.format(idx))
+        manager = SimulatedManager(stats, mqtt_client=client, flash_configs=flash_configs, http_config=http_config,
+                                   machine_ids=group, queue_size=args.queue_size, rollover=args.rollover,
+                                   ledger_dir=tempfile.mkdtemp())
+        manager.authenticate()
+        client.on_message = manager.on_message
+        client.on_connect = manager.on_connect
+        clients.append(connect(client, address, credentials))
+        manager.start()
+        managers.append(manager)
+    machines = [machine for manager in managers for machine in manager.machines.values()]
+    orders_client = connect(mqtt.Client(client_id='simulator-orders'), address, credentials)
+    time.sleep(0.5)
+
+    # open and fund all channels
+    for command, state in (('init', State.INITIALISED), ('fund', State.FUNDED)):
+        for machine in machines:
+            orders_client.publish(machine.topic(command), qos=1)
+        if not wait_until(lambda: all(m.current_state == state for m in machines), timeout=args.drain):
+            logging.warning('Not all machines reached {}'.format(state.name))
+
+    # order coffees of all machines in the order of their arrival
+    rng = random.Random(args.seed)
+    schedule = sorted(((t, machine) for machine in machines
+                       for t in arrivals(args.pattern, args.rate, args.duration, peak=args.peak, rng=rng)),
+                      key=lambda order: order[0])
+    start = time.monotonic()
+    for t, machine in schedule:
+        time.sleep(max(0.0, start + t - time.monotonic()))
+        mode = 'double' if rng.random() < args.double else 'single'
+        orders_client.publish(machine.topic('make'), payload=mode, qos=1)
+        stats.orders += 1
+    wait_until(lambda: stats.served + stats.refused + stats.dropped >= stats.orders and
+               all(manager.idle() for manager in managers), timeout=args.drain)
+    duration = time.monotonic() - start
+
+    for client in clients + [orders_client]:
+        client.loop_stop()
+        client.disconnect()
+    if broker:
+        broker.stop()
+    for server in servers:
+        server.stop()
+
+    server_latencies = [latency for server in servers for endpoint, values in server.latencies.items()
+                        if endpoint != 'token' for latency in values]
+    return {'machines': num_machines,
+            'orders': stats.orders,
+            'served': stats.served,
+            'refused': stats.refused,
+            'dropped': stats.dropped,
+            'duration': duration,
+            'coffees_per_second': stats.served / duration if duration else None,
+            'queue_delay': {'p50': percentile(stats.queue_delays, 0.5), 'p99': percentile(stats.queue_delays, 0.99)},
+            'service_time': {'p50': percentile(stats.service_times, 0.5),
+                             'p99': percentile(stats.service_times, 0.99)},
+            'server_latency': {'p50': percentile(server_latencies, 0.5), 'p99': percentile(server_latencies, 0.99)},
+            'mqtt_messages': sum(broker.messages.values()) if broker else None}
+
+
+def milliseconds(value):
+    return '{:8.1f}'.format(value * 1000) if value is not None else '       -'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--machines', type=int, nargs='+', default=[1, 5, 10], help='numbers of machines to run')
+    parser.add_argument('--pattern', choices=ARRIVAL_PATTERNS, default='poisson', help='arrival pattern of orders')
+    parser.add_argument('--rate', type=float, default=0.2, help='orders per second and machine')
+    parser.add_argument('--peak', type=float, default=4.0, help='peak of the morning rush relative to the rate')
+    parser.add_argument('--double', type=float, default=0.3, help='share of double coffees')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of ordering coffees')
+    parser.add_argument('--drain', type=float, default=60, help='seconds to wait for queued orders')
+    parser.add_argument('--latency', type=float, default=0.01, help='latency of each Flash call in seconds')
+    parser.add_argument('--concurrency', type=int, default=None, help='calls processed at once per Flash server')
+    parser.add_argument('--queue-size', type=int, default=16, help='commands queued per machine')
+    parser.add_argument('--rollover', action='store_true', help='roll over to new channels when exhausted')
+    parser.add_argument('--connection-per-machine', action='store_true', help='one MQTT connection per machine')
+    parser.add_argument('--broker', default=None, help='external MQTT broker as host:port')
+    parser.add_argument('--username', default=None, help='username of the external broker')
+    parser.add_argument('--password', default=None, help='password of the external broker')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the arrivals')
+    parser.add_argument('--results', default=None, help='JSON lines file to append results to')
+    args = parser.parse_args()
+
+    logging.getLogger('coffeemachine').setLevel(logging.WARNING)
+
+    print('machines  orders  served refused dropped  coffees/s  queue p50  queue p99  server p50  server p99')
+    for num_machines in args.machines:
+        result = run(num_machines, args)
+        print('{:8} {:7} {:7} {:7} {:7} {:10.2f} {} {} {}   {}'.format(
+            result['machines'], result['orders'], result['served'], result['refused'], result['dropped'],
+            result['coffees_per_second'] or 0, milliseconds(result['queue_delay']['p50']),
+            milliseconds(result['queue_delay']['p99']), milliseconds(result['server_latency']['p50']),
+            milliseconds(result['server_latency']['p99'])))
+        if args.results:
+            result['options'] = {k: v for k, v in vars(args).items() if k not in ('password', 'results')}
+            result['time'] = time.time()
+            with open(args.results, 'a') as results:
+                results.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
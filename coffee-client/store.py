@@ -0,0 +1,55 @@
+import json
+import logging
+import sqlite3
+import time
+from threading import Lock
+
+logger = logging.getLogger('coffeemachine')
+
+
+class ChannelStore:
+    """SQLite log of the channel state of coffee machines.
+
+    Every change is appended as a record of a kind (e.g. 'state', 'channel' or 'pending') and only the latest
+    record of each kind is needed for recovery. Records superseded by an appended record are deleted in the same
+    transaction, so that the log does not grow with the full flash objects of every payment.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS records ('
+                                'id INTEGER PRIMARY KEY AUTOINCREMENT, machine TEXT NOT NULL, kind TEXT NOT NULL, '
+                                'time REAL NOT NULL, record TEXT)')
+
+    def append(self, machine_id, kind, record):
+        self.append_all(machine_id, {kind: record})
+
+    def append_all(self, machine_id, records):
+        """Appends records of several kinds (kind -> record) in a single transaction."""
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                for kind, record in records.items():
+                    record_id = self.connection.execute(
+                        'INSERT INTO records (machine, kind, time, record) VALUES (?, ?, ?, ?)',
+                        (machine_id or '', kind, time.time(), json.dumps(record))).lastrowid
+                    self.connection.execute('DELETE FROM records WHERE machine = ? AND kind = ? AND id < ?',
+                                            (machine_id or '', kind, record_id))
+                self.connection.execute('COMMIT')
+            except:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def recover(self, machine_id):
+        """Returns the latest record of each kind of a machine and drops all older records."""
+        with self.lock:
+            rows = self.connection.execute('SELECT kind, record, MAX(id) FROM records WHERE machine = ? '
+                                           'GROUP BY kind', (machine_id or '',)).fetchall()
+            self.connection.execute('DELETE FROM records WHERE machine = ? AND id NOT IN '
+                                    '(SELECT MAX(id) FROM records WHERE machine = ? GROUP BY kind)',
+                                    (machine_id or '', machine_id or ''))
+        return {kind: json.loads(record) for kind, record, _ in rows}
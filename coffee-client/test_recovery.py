@@ -0,0 +1,148 @@
+"""Tests of resuming coffee machines from the channel store after a crash, run against fake Flash servers via
+
+    python -m unittest test_recovery
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import settings
+from fake_flash import FakeFlashServer
+from ledger import Ledger
+from machine import PRICE_SINGLE_COFFEE, ChannelManager, State
+from store import ChannelStore
+
+
+class FakeMqtt:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload))
+
+
+class Crash(Exception):
+    """Stops a machine in the middle of an operation, like a crash of the client."""
+
+
+class RecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = [FakeFlashServer().start() for _ in range(2)]
+        self.directory = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.directory, 'channels.db')
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.directory)
+
+    def start_machine(self, **machine_options):
+        """Starts a client (as after a restart) and returns its recovered machine."""
+        flash_configs = [{'url': server.url, 'username': 'user', 'password': 'password'} for server in self.servers]
+        manager = ChannelManager(mqtt_client=FakeMqtt(), flash_configs=flash_configs,
+                                 http_config=settings.section(settings.read_config(), 'HTTP'),
+                                 store=ChannelStore(self.store_path), ledger_dir=self.directory, **machine_options)
+        manager.authenticate()
+        machine = manager.machines[None]
+        machine.recover()
+        return machine
+
+    def open_channel(self, machine):
+        machine.execute_command('init', b'')
+        machine.execute_command('fund', b'')
+        self.assertEqual(machine.current_state, State.FUNDED)
+
+    def test_applied_pending_bundles_are_not_applied_again(self):
+        machine = self.start_machine()
+        self.open_channel(machine)
+        machine.execute_command('make', b'single')
+        deposit, sequence, digests = list(machine.channel.deposit), machine.channel.sequence, machine.channel.digests
+
+        # crash after the channel was persisted, but before the pending bundles were cleared
+        bundles = machine.sign_bundles(machine.compose_transfer(PRICE_SINGLE_COFFEE))
+        machine.store.append(None, 'pending', {'channel_ids': machine.channel.channel_ids, 'sequence': sequence - 1,
+                                               'bundles': bundles, 'settled': None})
+
+        recovered = self.start_machine()
+        self.assertEqual(recovered.current_state, State.FUNDED)
+        self.assertEqual(recovered.channel.deposit, deposit)
+        self.assertEqual(recovered.channel.sequence, sequence)
+        self.assertEqual(recovered.channel.digests, digests)
+        self.assertIsNone(recovered.store.recover(None)['pending'])
+
+    def test_pending_bundles_are_applied_on_recovery(self):
+        machine = self.start_machine()
+        self.open_channel(machine)
+        deposit = machine.channel.deposit[0]
+
+        # crash after the bundles were persisted as pending, but before they were applied
+        with mock.patch.object(machine, 'fan_out', side_effect=Crash):
+            self.assertRaises(Crash, machine.pay_for_coffee, PRICE_SINGLE_COFFEE, 1)
+
+        recovered = self.start_machine()
+        self.assertEqual(recovered.channel.deposit[0], deposit - PRICE_SINGLE_COFFEE)
+        self.assertEqual(recovered.channel.sequence, 1)
+
+    def test_settled_coffees_are_not_paid_again(self):
+        machine = self.start_machine(aggregate=True, settle_value=100 * PRICE_SINGLE_COFFEE)
+        self.open_channel(machine)
+        for _ in range(3):
+            machine.execute_command('make', b'single')
+        deposit = machine.channel.deposit[0]
+
+        # crash after the settlement was persisted, but before the coffees were removed from the ledger
+        with mock.patch.object(Ledger, 'clear', side_effect=Crash):
+            self.assertRaises(Crash, machine.settle)
+        self.assertEqual(len(Ledger(machine.ledger.path)), 3)
+
+        recovered = self.start_machine(aggregate=True, settle_value=100 * PRICE_SINGLE_COFFEE)
+        self.assertEqual(len(recovered.ledger), 0)
+        self.assertEqual(recovered.channel.deposit[0], deposit - 3 * PRICE_SINGLE_COFFEE)
+        self.assertEqual(recovered.available_deposit, deposit - 3 * PRICE_SINGLE_COFFEE)
+
+    def test_overdue_coffees_are_settled_after_recovery(self):
+        machine = self.start_machine(aggregate=True, settle_value=100 * PRICE_SINGLE_COFFEE)
+        self.open_channel(machine)
+        for _ in range(2):
+            machine.execute_command('make', b'single')
+
+        recovered = self.start_machine(aggregate=True, settle_value=100 * PRICE_SINGLE_COFFEE, settle_interval=0)
+        self.assertEqual(len(recovered.ledger), 2)
+        recovered.settle_timer.join(timeout=5)
+        self.assertIn(('/coffee/settle', None), recovered.mqtt_client.published)
+
+    def test_settlement_is_not_requested_before_recovery(self):
+        machine = self.start_machine(aggregate=True, settle_value=100 * PRICE_SINGLE_COFFEE)
+        self.open_channel(machine)
+        machine.execute_command('make', b'single')
+
+        flash_configs = [{'url': server.url, 'username': 'user', 'password': 'password'} for server in self.servers]
+        manager = ChannelManager(mqtt_client=FakeMqtt(), flash_configs=flash_configs,
+                                 http_config=settings.section(settings.read_config(), 'HTTP'),
+                                 ledger_dir=self.directory, aggregate=True, settle_interval=0)
+        self.assertIsNone(manager.machines[None].settle_timer)
+
+
+class ChannelStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = ChannelStore(os.path.join(self.directory, 'channels.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_only_latest_record_of_each_kind_is_kept(self):
+        for sequence in range(5):
+            self.store.append('kitchen', 'channel', {'sequence': sequence})
+        self.store.append_all('kitchen', {'channel': {'sequence': 5}, 'pending': None})
+        self.store.append('office', 'channel', {'sequence': 0})
+
+        rows = self.store.connection.execute('SELECT machine, kind FROM records ORDER BY id').fetchall()
+        self.assertEqual(rows, [('kitchen', 'channel'), ('kitchen', 'pending'), ('office', 'channel')])
+        self.assertEqual(self.store.recover('kitchen'), {'channel': {'sequence': 5}, 'pending': None})
+
+
+if __name__ == '__main__':
+    unittest.main()
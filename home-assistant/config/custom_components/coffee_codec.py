@@ -0,0 +1,46 @@
+"""Decoding of the MQTT payloads published by the coffee client (see coffee-client/codec.py)."""
+import json
+import string
+import struct
+
+TRYTES = '9' + string.ascii_uppercase
+
+# extension type (MessagePack) and tag (CBOR) of packed trytes
+TRYTES_EXT_TYPE = 27
+TRYTES_TAG = 27027
+
+
+def topic(base_topic, encoding):
+    """Returns the topic of a payload in an encoding (e.g. /coffee/flash/msgpack), JSON uses the plain topic."""
+    return base_topic if encoding == 'json' else '{}/{}'.format(base_topic, encoding)
+
+
+def unpack_trytes(data):
+    length = struct.unpack('!I', data[:4])[0]
+    trytes = []
+    for idx in range(4, len(data), 3):
+        value = int.from_bytes(data[idx:idx + 3], 'big')
+        group = []
+        for _ in range(5):
+            value, tryte = divmod(value, 27)
+            group.append(TRYTES[tryte])
+        trytes.extend(reversed(group))
+    return ''.join(trytes[:length])
+
+
+def decode(data, encoding='json'):
+    if encoding == 'msgpack':
+        import msgpack
+
+        def ext_hook(code, ext_data):
+            return unpack_trytes(ext_data) if code == TRYTES_EXT_TYPE else msgpack.ExtType(code, ext_data)
+        return msgpack.unpackb(data, ext_hook=ext_hook, raw=False)
+    if encoding == 'cbor':
+        import cbor2
+
+        def tag_hook(*args):
+            # called with (decoder, tag) or (tag, immutable), depending on the version of cbor2
+            tag = next(arg for arg in args if isinstance(arg, cbor2.CBORTag))
+            return unpack_trytes(tag.value) if tag.tag == TRYTES_TAG else tag
+        return cbor2.loads(data, tag_hook=tag_hook)
+    return json.loads(data.decode('utf-8') if isinstance(data, bytes) else data)
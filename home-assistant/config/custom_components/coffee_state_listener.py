@@ -1,5 +1,6 @@
 import logging
 
+from homeassistant.core import callback
 from homeassistant.helpers.event import track_state_change
 
 _LOGGER = logging.getLogger(__name__)
@@ -18,55 +19,83 @@ COFFEE_TRANSACTION = 'weblink.coffee_machine_transaction'
 COFFEE_FLASH_SERVER = 'weblink.coffee_flash_server'
 PROVIDER_FLASH_SERVER = 'weblink.provider_flash_server'
 
+# state changes within this time are applied at once (e.g. FUNDED -> CLOSING -> CLOSED)
+DEBOUNCE_SECONDS = 0.5
+
+# entities shown and hidden in each state (entities not listed keep their visibility)
+UNINITIALISED_VISIBILITY = (
+    [INIT_COFFEE_SCRIPT],
+    [SINGLE_COFFEE_SCRIPT, DOUBLE_COFFEE_SCRIPT, FUND_COFFEE_SCRIPT, ADDRESSES_COFFEE_SENSOR, CLOSE_COFFEE_SCRIPT,
+     BALANCE_COFFEE_SENSOR, PROVIDER_TRANSACTION, COFFEE_TRANSACTION, COFFEE_FLASH_SERVER, PROVIDER_FLASH_SERVER])
+EXHAUSTED_VISIBILITY = (
+    [CLOSE_COFFEE_SCRIPT, BALANCE_COFFEE_SENSOR],
+    [SINGLE_COFFEE_SCRIPT, DOUBLE_COFFEE_SCRIPT, FUND_COFFEE_SCRIPT, INIT_COFFEE_SCRIPT, PROVIDER_TRANSACTION,
+     COFFEE_TRANSACTION])
+VISIBILITY = {
+    'unknown': UNINITIALISED_VISIBILITY,
+    'UNINITIALISED': UNINITIALISED_VISIBILITY,
+    'INITIALISING': UNINITIALISED_VISIBILITY,
+    'ERROR': UNINITIALISED_VISIBILITY,
+    'INITIALISED': ([FUND_COFFEE_SCRIPT, ADDRESSES_COFFEE_SENSOR],
+                    [INIT_COFFEE_SCRIPT, BALANCE_COFFEE_SENSOR]),
+    'FUNDED': ([BALANCE_COFFEE_SENSOR, CLOSE_COFFEE_SCRIPT, SINGLE_COFFEE_SCRIPT, DOUBLE_COFFEE_SCRIPT,
+                ADDRESSES_COFFEE_SENSOR],
+               [FUND_COFFEE_SCRIPT]),
+    'CLOSING': ([],
+                [SINGLE_COFFEE_SCRIPT, DOUBLE_COFFEE_SCRIPT]),
+    'CLOSED': ([INIT_COFFEE_SCRIPT],
+               [SINGLE_COFFEE_SCRIPT, DOUBLE_COFFEE_SCRIPT, FUND_COFFEE_SCRIPT, ADDRESSES_COFFEE_SENSOR,
+                CLOSE_COFFEE_SCRIPT, BALANCE_COFFEE_SENSOR, COFFEE_TRANSACTION, PROVIDER_TRANSACTION]),
+    'NO_FUNDS': EXHAUSTED_VISIBILITY,
+    'NO_ADDRESSES_LEFT': EXHAUSTED_VISIBILITY,
+}
+
 
 def setup(hass, config):
+    pending = {'states': [], 'handle': None}
+
+    @callback
+    def apply_visibility():
+        hidden = visibility(pending['states'])
+        pending['states'], pending['handle'] = [], None
+
+        changed = [entity_id for entity_id, is_hidden in hidden.items() if hide_entity(hass, entity_id, is_hidden)]
+        if changed:
+            _LOGGER.info('Changed visibility of {}'.format(', '.join(changed)))
+
+    @callback
     def coffee_state_changed(entity_id, old_state, new_state):
         _LOGGER.info('{} changed to {}'.format(entity_id, new_state.state))
 
-        if new_state.state in ['unknown', 'INITIALISING', 'UNINITIALISED', 'ERROR']:
-            # hide all but init
-            hide_entity(hass, entity_id=INIT_COFFEE_SCRIPT, hidden=False)
-            for e in [SINGLE_COFFEE_SCRIPT, DOUBLE_COFFEE_SCRIPT, FUND_COFFEE_SCRIPT, ADDRESSES_COFFEE_SENSOR,
-                      CLOSE_COFFEE_SCRIPT, BALANCE_COFFEE_SENSOR, PROVIDER_TRANSACTION, COFFEE_TRANSACTION,
-                      COFFEE_FLASH_SERVER, PROVIDER_FLASH_SERVER]:
-                hide_entity(hass, entity_id=e, hidden=True)
-        elif new_state.state == 'INITIALISED':
-            hide_entity(hass, entity_id=INIT_COFFEE_SCRIPT, hidden=True)
-            hide_entity(hass, entity_id=FUND_COFFEE_SCRIPT, hidden=False)
-            hide_entity(hass, entity_id=BALANCE_COFFEE_SENSOR, hidden=True)
-            hide_entity(hass, entity_id=ADDRESSES_COFFEE_SENSOR, hidden=False)
-        elif new_state.state == 'FUNDED':
-            hide_entity(hass, entity_id=FUND_COFFEE_SCRIPT, hidden=True)
-            hide_entity(hass, entity_id=BALANCE_COFFEE_SENSOR, hidden=False)
-            hide_entity(hass, entity_id=CLOSE_COFFEE_SCRIPT, hidden=False)
-            hide_entity(hass, entity_id=SINGLE_COFFEE_SCRIPT, hidden=False)
-            hide_entity(hass, entity_id=DOUBLE_COFFEE_SCRIPT, hidden=False)
-            hide_entity(hass, entity_id=ADDRESSES_COFFEE_SENSOR, hidden=False)
-        elif new_state.state == 'CLOSING':
-            hide_entity(hass, entity_id=SINGLE_COFFEE_SCRIPT, hidden=True)
-            hide_entity(hass, entity_id=DOUBLE_COFFEE_SCRIPT, hidden=True)
-        elif new_state.state == 'CLOSED':
-            hide_entity(hass, entity_id=INIT_COFFEE_SCRIPT, hidden=False)
-            # hide all but init and transaction
-            for e in [SINGLE_COFFEE_SCRIPT, DOUBLE_COFFEE_SCRIPT, FUND_COFFEE_SCRIPT, ADDRESSES_COFFEE_SENSOR,
-                      CLOSE_COFFEE_SCRIPT, BALANCE_COFFEE_SENSOR, COFFEE_TRANSACTION, PROVIDER_TRANSACTION]:
-                hide_entity(hass, entity_id=e, hidden=True)
-        elif new_state.state in ['NO_FUNDS', 'NO_ADDRESSES_LEFT']:
-            for e in [SINGLE_COFFEE_SCRIPT, DOUBLE_COFFEE_SCRIPT, FUND_COFFEE_SCRIPT,
-                      INIT_COFFEE_SCRIPT, PROVIDER_TRANSACTION, COFFEE_TRANSACTION]:
-                hide_entity(hass, entity_id=e, hidden=True)
-            hide_entity(hass, entity_id=CLOSE_COFFEE_SCRIPT, hidden=False)
-            hide_entity(hass, entity_id=BALANCE_COFFEE_SENSOR, hidden=False)
+        # apply the visibility once the state settled
+        pending['states'].append(new_state.state)
+        if pending['handle']:
+            pending['handle'].cancel()
+        pending['handle'] = hass.loop.call_later(DEBOUNCE_SECONDS, apply_visibility)
 
     track_state_change(hass, entity_ids=['sensor.coffee_machine_state'], action=coffee_state_changed)
 
     return True
 
 
+def visibility(states):
+    """Returns whether entities are hidden after passing through states."""
+    hidden = {}
+    for state in states:
+        visible_entities, hidden_entities = VISIBILITY.get(state, ([], []))
+        hidden.update({entity_id: False for entity_id in visible_entities})
+        hidden.update({entity_id: True for entity_id in hidden_entities})
+    return hidden
+
+
+@callback
 def hide_entity(hass, entity_id, hidden):
-    _LOGGER.info("Changing hidden state of {} to {}".format(entity_id, hidden))
+    """Changes the hidden state of an entity and returns whether it changed."""
     entity = hass.states.get(entity_id)
-    if entity:
-        attributes = {k: v for k, v in entity.attributes.items()}
-        attributes['hidden'] = hidden
-        hass.states.set(entity_id, entity.state, attributes, force_update=True)
+    if not entity or entity.attributes.get('hidden', False) == hidden:
+        return False
+
+    attributes = {k: v for k, v in entity.attributes.items()}
+    attributes['hidden'] = hidden
+    hass.states.async_set(entity_id, entity.state, attributes)
+    return True
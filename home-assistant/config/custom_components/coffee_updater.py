@@ -1,8 +1,14 @@
+import asyncio
 import logging
-import json
+import time
+from collections import OrderedDict
 
 import homeassistant.loader as loader
 import os
+from homeassistant.core import callback
+from homeassistant.util import slugify
+
+from custom_components import coffee_codec
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -13,63 +19,151 @@ DOMAIN = 'coffee_updater'
 DEPENDENCIES = ['mqtt']
 
 CONF_TOPIC = 'topic'
+CONF_ENCODING = 'encoding'
 
 EXPLORER_BASE_URL = 'http://iota-node.duckdns.org:8081/#/bundle/'
 
+TOPIC_ROOT = '/coffee'
+
+# number of recent bundles and channels kept per coffee machine
+HISTORY_SIZE = 20
+
 COFFEE_FLASH_BASE_URL = os.getenv('COFFEE_FLASH_BASE_URL', 'http://localhost:3000')
 PROVIDER_FLASH_BASE_URL = os.getenv('PROVIDER_FLASH_BASE_URL', 'http://localhost:3001')
 
 
-def setup(hass, config):
+@asyncio.coroutine
+def async_setup(hass, config):
     mqtt = loader.get_component('mqtt')
 
+    # encoding of payloads published by the coffee client (json, msgpack or cbor)
+    encoding = (config.get(DOMAIN) or {}).get(CONF_ENCODING, 'json')
+
+    histories = {}
+
+    def history(topic):
+        # topics of the coffee client are /coffee/<name> or /coffee/<machine_id>/<name> (plus encoding)
+        parts = topic[len(TOPIC_ROOT) + 1:].split('/')
+        if encoding != 'json':
+            parts = parts[:-1]
+        machine_id = parts[0] if len(parts) > 1 else None
+        if machine_id not in histories:
+            histories[machine_id] = CoffeeHistory(hass, machine_id)
+        return histories[machine_id]
+
     # Listener to be called when we receive a message.
+    @callback
     def transaction_message(topic, payload, qos):
-        payload = json.loads(payload)
+        payload = coffee_codec.decode(payload, encoding)
         _LOGGER.info('Received {}'.format(payload))
         bundle_hashes = payload['bundle_hashes']
         reason = payload['reason']
 
-        hass.states.set('weblink.coffee_machine_transaction', EXPLORER_BASE_URL + bundle_hashes[0],
-                        attributes={
-                            'hidden': False,
-                            'friendly_name': '{} Transaction (Coffee Machine)'.format(reason)
-                        },
-                        force_update=True)
+        # skip retained messages replayed on reconnects
+        machine_history = history(topic)
+        if not machine_history.add_bundles(bundle_hashes, reason) or machine_history.machine_id is not None:
+            return
 
-        if len(bundle_hashes) > 1:
-            hass.states.set('weblink.coffee_provider_transaction', EXPLORER_BASE_URL + bundle_hashes[1],
-                            attributes={
-                                'hidden': False,
-                                'friendly_name': '{} Transaction (Coffee Machine Provider)'.format(reason)
-                            },
-                            force_update=True)
+        hass.states.async_set('weblink.coffee_machine_transaction', EXPLORER_BASE_URL + bundle_hashes[0],
+                              attributes={
+                                  'hidden': False,
+                                  'friendly_name': '{} Transaction (Coffee Machine)'.format(reason)
+                              },
+                              force_update=True)
 
+        if len(bundle_hashes) > 1:
+            hass.states.async_set('weblink.coffee_provider_transaction', EXPLORER_BASE_URL + bundle_hashes[1],
+                                  attributes={
+                                      'hidden': False,
+                                      'friendly_name': '{} Transaction (Coffee Machine Provider)'.format(reason)
+                                  },
+                                  force_update=True)
+
+    @callback
     def flash_init_message(topic, payload, qos):
-        payload = json.loads(payload)
+        payload = coffee_codec.decode(payload, encoding)
         _LOGGER.info('Received {}'.format(payload))
         channel_ids = payload['channel_ids']
 
-        hass.states.set('weblink.coffee_flash_server',
-                        '{}/#/channel/{}'.format(COFFEE_FLASH_BASE_URL, channel_ids[0]),
-                        attributes={
-                            'hidden': False,
-                            'friendly_name': 'Link to Flash Server Coffee Machine'
-                        },
-                        force_update=True)
+        # skip retained messages replayed on reconnects
+        machine_history = history(topic)
+        if not machine_history.add_channels(channel_ids) or machine_history.machine_id is not None:
+            return
+
+        hass.states.async_set('weblink.coffee_flash_server',
+                              '{}/#/channel/{}'.format(COFFEE_FLASH_BASE_URL, channel_ids[0]),
+                              attributes={
+                                  'hidden': False,
+                                  'friendly_name': 'Link to Flash Server Coffee Machine'
+                              },
+                              force_update=True)
 
         if len(channel_ids) > 1:
-            hass.states.set('weblink.provider_flash_server',
-                            '{}/#/channel/{}'.format(PROVIDER_FLASH_BASE_URL, channel_ids[1]),
-                            attributes={
-                                'hidden': False,
-                                'friendly_name': 'Link to Flash Server Service Provider'
-                            },
-                            force_update=True)
-
-    # Subscribe our listener to a topic.
-    mqtt.subscribe(hass, '/coffee/transactions', transaction_message)
-    mqtt.subscribe(hass, '/coffee/channel_ids', flash_init_message)
+            hass.states.async_set('weblink.provider_flash_server',
+                                  '{}/#/channel/{}'.format(PROVIDER_FLASH_BASE_URL, channel_ids[1]),
+                                  attributes={
+                                      'hidden': False,
+                                      'friendly_name': 'Link to Flash Server Service Provider'
+                                  },
+                                  force_update=True)
+
+    # Subscribe our listener to the topics of the default machine and all machines with ids.
+    payload_encoding = 'utf-8' if encoding == 'json' else None
+    for name, listener in [('transactions', transaction_message), ('channel_ids', flash_init_message)]:
+        for machine_topic in ['{}/{}', '{}/+/{}']:
+            yield from mqtt.async_subscribe(hass, coffee_codec.topic(machine_topic.format(TOPIC_ROOT, name), encoding),
+                                            listener, encoding=payload_encoding)
 
     # Return boolean to indicate that initialization was successfully.
     return True
+
+
+class CoffeeHistory(object):
+    """Recent bundles and channels of a coffee machine, exposed as attributes of an entity.
+
+    Both are kept in order of their last appearance and limited to HISTORY_SIZE entries. Updates, which contain
+    only known bundles or channels (e.g. retained messages replayed after reconnecting), are ignored.
+    """
+
+    def __init__(self, hass, machine_id):
+        self.hass = hass
+        self.machine_id = machine_id
+        self.entity_id = 'sensor.coffee_machine_history' if machine_id is None else \
+            'sensor.coffee_machine_{}_history'.format(slugify(machine_id))
+        self.bundles = OrderedDict()
+        self.channels = OrderedDict()
+
+    @callback
+    def add_bundles(self, bundle_hashes, reason):
+        """Adds bundles and returns whether any of them was new."""
+        if all(bundle_hash in self.bundles for bundle_hash in bundle_hashes):
+            return False
+        for bundle_hash in bundle_hashes:
+            self.bundles.pop(bundle_hash, None)
+            self.bundles[bundle_hash] = {'bundle': bundle_hash, 'reason': reason, 'time': time.time(),
+                                         'url': EXPLORER_BASE_URL + bundle_hash}
+        self._update(reason)
+        return True
+
+    @callback
+    def add_channels(self, channel_ids):
+        """Adds the channel ids of a new channel and returns whether it was new."""
+        key = tuple(channel_ids)
+        if key in self.channels:
+            return False
+        self.channels[key] = {'channel_ids': list(channel_ids), 'time': time.time(),
+                              'url': '{}/#/channel/{}'.format(COFFEE_FLASH_BASE_URL, channel_ids[0])}
+        self._update('Channel opened')
+        return True
+
+    def _update(self, state):
+        for entries in [self.bundles, self.channels]:
+            while len(entries) > HISTORY_SIZE:
+                entries.popitem(last=False)
+
+        name = 'Coffee Machine' if self.machine_id is None else 'Coffee Machine {}'.format(self.machine_id)
+        self.hass.states.async_set(self.entity_id, state, attributes={
+            'friendly_name': '{} History'.format(name),
+            'bundles': list(reversed(self.bundles.values())),
+            'channels': list(reversed(self.channels.values())),
+        })
@@ -5,7 +5,11 @@ For more details about this component, please refer to the documentation at
 https://home-assistant.io/components/iota/
 """
 import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import timedelta
+from threading import Thread
+from urllib.parse import urlsplit
 
 import voluptuous as vol
 
@@ -20,7 +24,29 @@ IOTA_PLATFORMS = ['sensor']
 
 SCAN_INTERVAL = timedelta(minutes=10)
 
+DATA_IOTA = 'iota'
+DATA_IOTA_FEED = 'iota_feed'
+
+# connections kept alive per IRI node and timeout of requests
+POOL_SIZE = 10
+REQUEST_TIMEOUT = 30
+
+# time a node is skipped after a failed request, milestones a node may lag behind and weight of new latencies
+FAILURE_COOLDOWN = timedelta(seconds=60)
+SYNC_TOLERANCE = 1
+LATENCY_WEIGHT = 0.3
+
+# read-only commands, which may be sent to a second node if the first one is slow
+HEDGED_COMMANDS = ('getBalances', 'findTransactions', 'getNodeInfo', 'getTrytes', 'getInclusionStates',
+                   'wereAddressesSpentFrom')
+
+# topic of confirmed transactions in feeds of IRI nodes and time without messages after which a feed is considered down
+FEED_TOPIC = 'sn'
+FEED_TIMEOUT = timedelta(minutes=10)
+
 CONF_IRI = 'iri'
+CONF_FEED = 'feed'
+CONF_HEDGE_DELAY = 'hedge_delay'
 CONF_TESTNET = 'testnet'
 CONF_WALLETS = 'wallets'
 CONF_WALLET_NAME = 'name'
@@ -33,7 +59,9 @@ WALLET_CONFIG = vol.Schema({
 
 CONFIG_SCHEMA = vol.Schema({
     DOMAIN: vol.Schema({
-        vol.Required(CONF_IRI): cv.string,
+        vol.Required(CONF_IRI): vol.All(cv.ensure_list, [cv.string]),
+        vol.Optional(CONF_FEED): cv.string,
+        vol.Optional(CONF_HEDGE_DELAY): vol.All(vol.Coerce(float), vol.Range(min=0)),
         vol.Optional(CONF_TESTNET, default=False): cv.boolean,
         vol.Required(CONF_WALLETS): vol.All(cv.ensure_list, [WALLET_CONFIG])
     })
@@ -47,7 +75,248 @@ def setup(hass, config):
 
     # Load platforms
     iota_config = config[DOMAIN]
+    hass.data[DATA_IOTA] = IriNodePool(iota_config[CONF_IRI], hedge_delay=iota_config.get(CONF_HEDGE_DELAY))
+    if CONF_FEED in iota_config:
+        hass.data[DATA_IOTA_FEED] = IotaFeed(iota_config[CONF_FEED])
+        hass.data[DATA_IOTA_FEED].start()
     for platform in IOTA_PLATFORMS:
         load_platform(hass, platform, DOMAIN, iota_config, config)
 
     return True
+
+
+def create_adapter(iri):
+    """Create an adapter keeping a pool of connections to the IRI node alive."""
+    import requests
+    from iota.adapter import HttpAdapter
+
+    class PooledHttpAdapter(HttpAdapter):
+        def __init__(self, uri):
+            super().__init__(uri)
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=POOL_SIZE)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+
+        def _send_http_request(self, url, payload, method='post', **kwargs):
+            kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+            return self.session.request(method=method, url=url, data=payload, **kwargs)
+
+    return PooledHttpAdapter(iri)
+
+
+def create_pool_adapter(pool):
+    """Create an adapter sending the requests of API objects via a pool of IRI nodes."""
+    from iota.adapter import BaseAdapter
+
+    class PoolAdapter(BaseAdapter):
+        def get_uri(self):
+            return pool.best().url
+
+        def send_request(self, payload, **kwargs):
+            return pool.send_request(payload, **kwargs)
+
+    return PoolAdapter()
+
+
+def get_api(hass, seed=None):
+    """Return an API object for a seed, sharing the pool of IRI nodes."""
+    from iota import Iota
+    return Iota(adapter=hass.data[DATA_IOTA].adapter, seed=seed)
+
+
+class IriNode(object):
+    """IRI node of a pool with its latest node info and a moving average of its latency."""
+
+    def __init__(self, url, adapter):
+        """Initialize the node."""
+        self.url = url
+        self.adapter = adapter
+        self.info = None
+        self.latency = None
+        self.failed_until = 0
+
+    @property
+    def available(self):
+        """Return whether the node did not fail recently."""
+        return time.monotonic() >= self.failed_until
+
+    @property
+    def milestone(self):
+        """Return the latest milestone known to the node."""
+        return self.info['latestMilestoneIndex'] if self.info else 0
+
+    def in_sync(self, milestone):
+        """Return whether the node is solid up to its latest milestone and not behind a milestone of the pool."""
+        if self.info is None:
+            return True
+        return self.info['latestSolidSubtangleMilestoneIndex'] >= self.milestone - SYNC_TOLERANCE and \
+            self.milestone >= milestone - SYNC_TOLERANCE
+
+    def succeeded(self, latency):
+        """Record the latency of a successful request."""
+        self.failed_until = 0
+        self.latency = latency if self.latency is None else \
+            LATENCY_WEIGHT * latency + (1 - LATENCY_WEIGHT) * self.latency
+
+    def failed(self):
+        """Skip the node for a while."""
+        self.failed_until = time.monotonic() + FAILURE_COOLDOWN.total_seconds()
+
+
+class IriNodePool(object):
+    """Pool of IRI nodes, which routes requests to the fastest available node in sync.
+
+    Nodes are health-checked with their node info, which tells whether they are in sync with the latest milestone
+    of all nodes, and ranked by the moving average of their latencies, where nodes not yet measured are tried
+    first. A failed request is retried with the next node, whereas the failed node is skipped for
+    FAILURE_COOLDOWN. With a hedge delay, read-only requests are additionally sent to the next node if the first
+    one did not respond within the delay and the first response is used.
+    """
+
+    def __init__(self, urls, hedge_delay=None, adapter_factory=create_adapter):
+        """Initialize the pool."""
+        self.nodes = [IriNode(url, adapter_factory(url)) for url in urls]
+        self.hedge_delay = hedge_delay
+        self._executor = ThreadPoolExecutor(max_workers=POOL_SIZE)
+        self._adapter = None
+
+    @property
+    def adapter(self):
+        """Return a pyota adapter of the pool."""
+        if self._adapter is None:
+            self._adapter = create_pool_adapter(self)
+        return self._adapter
+
+    def ranked(self):
+        """Return the nodes ordered from the best to the worst."""
+        milestone = max(node.milestone for node in self.nodes)
+        return sorted(self.nodes, key=lambda node: (not node.available, not node.in_sync(milestone),
+                                                   node.latency or 0))
+
+    def best(self):
+        """Return the node requests are sent to first."""
+        return self.ranked()[0]
+
+    def check_nodes(self):
+        """Fetch the node info of all nodes in parallel."""
+        def check(node):
+            try:
+                node.info = self.request(node, {'command': 'getNodeInfo'})
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.warning('IRI node %s is not available', node.url)
+        list(self._executor.map(check, self.nodes))
+
+    def status(self):
+        """Return a short description of the state of each node."""
+        milestone = max(node.milestone for node in self.nodes)
+        status = {}
+        for node in self.nodes:
+            if not node.available:
+                status[node.url] = 'failed'
+            elif not node.in_sync(milestone):
+                status[node.url] = 'syncing'
+            else:
+                status[node.url] = 'ok' if node.latency is None else '{:.0f} ms'.format(node.latency * 1000)
+        return status
+
+    def request(self, node, payload, **kwargs):
+        """Send a request to a single node, recording its latency or failure."""
+        start = time.monotonic()
+        try:
+            response = node.adapter.send_request(payload, **kwargs)
+        except Exception:
+            node.failed()
+            raise
+        node.succeeded(time.monotonic() - start)
+        return response
+
+    def send_request(self, payload, **kwargs):
+        """Send a request to the best node, failing over to the next nodes on errors."""
+        nodes = self.ranked()
+        if self.hedge_delay is not None and len(nodes) > 1 and payload.get('command') in HEDGED_COMMANDS:
+            return self._send_hedged(nodes, payload, kwargs)
+
+        error = None
+        for node in nodes:
+            try:
+                return self.request(node, payload, **dict(kwargs))
+            except Exception as exc:  # pylint: disable=broad-except
+                _LOGGER.warning('Request %s to %s failed: %s', payload.get('command'), node.url, exc)
+                error = exc
+        raise error
+
+    def _send_hedged(self, nodes, payload, kwargs):
+        """Send a request to the next node whenever the pending ones are slower than the hedge delay or fail."""
+        pending, error = set(), None
+        while nodes or pending:
+            if nodes:
+                pending.add(self._executor.submit(self.request, nodes.pop(0), payload, **dict(kwargs)))
+            done, pending = wait(pending, timeout=self.hedge_delay if nodes else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                _LOGGER.warning('Request %s failed: %s', payload.get('command'), future.exception())
+                error = future.exception()
+        raise error
+
+
+class IotaFeed(object):
+    """Listener of transactions confirmed by an IRI node.
+
+    Subscribes to the sn topic of the ZMQ feed (tcp://<host>:5556, requires pyzmq) or of an MQTT feed
+    (mqtt://<host>:1883) of the node and calls listeners with the address and hash of each confirmed transaction.
+    """
+
+    def __init__(self, url):
+        """Initialize the feed."""
+        self.url = url
+        self.listeners = []
+        self.last_message = None
+
+    @property
+    def healthy(self):
+        """Return whether the feed delivered messages recently."""
+        return self.last_message is not None and \
+            time.monotonic() - self.last_message < FEED_TIMEOUT.total_seconds()
+
+    def subscribe(self, listener):
+        """Call listener(address, transaction_hash) on confirmed transactions."""
+        self.listeners.append(listener)
+
+    def start(self):
+        """Start listening in a background thread."""
+        target = self._listen_mqtt if urlsplit(self.url).scheme == 'mqtt' else self._listen_zmq
+        Thread(target=target, name='IotaFeed', daemon=True).start()
+
+    def handle(self, message):
+        """Handle a message of the feed (e.g. sn <milestone> <hash> <address> <trunk> <branch> <bundle>)."""
+        self.last_message = time.monotonic()
+        parts = message.split(' ')
+        if parts[0] != FEED_TOPIC or len(parts) < 4:
+            return
+        for listener in self.listeners:
+            try:
+                listener(parts[3], parts[2])
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception('Error while handling transaction %s', parts[2])
+
+    def _listen_zmq(self):
+        import zmq
+        socket = zmq.Context.instance().socket(zmq.SUB)
+        socket.connect(self.url)
+        socket.setsockopt_string(zmq.SUBSCRIBE, FEED_TOPIC + ' ')
+        _LOGGER.info('Listening to feed %s', self.url)
+        while True:
+            self.handle(socket.recv_string())
+
+    def _listen_mqtt(self):
+        import paho.mqtt.client as mqtt
+        url = urlsplit(self.url)
+        client = mqtt.Client()
+        client.on_connect = lambda client_, userdata, flags, rc: client_.subscribe(FEED_TOPIC)
+        client.on_message = lambda client_, userdata, msg: self.handle(
+            '{} {}'.format(msg.topic, msg.payload.decode('utf-8')))
+        client.connect_async(url.hostname, url.port or 1883)
+        _LOGGER.info('Listening to feed %s', self.url)
+        client.loop_forever(retry_first_connection=True)
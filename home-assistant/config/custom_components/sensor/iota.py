@@ -4,10 +4,19 @@ Support for IOTA wallets.
 For more details about this component, please refer to the documentation at
 https://home-assistant.io/components/iota
 """
+import hashlib
+import json
 import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from threading import Lock
 
 from homeassistant.helpers.entity import Entity
+from homeassistant.util import Throttle
+
+from custom_components.iota import DATA_IOTA, DATA_IOTA_FEED, get_api
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -15,13 +24,40 @@ DEPENDENCIES = ['iota']
 
 SCAN_INTERVAL = timedelta(minutes=3)
 
+# balances of all wallets are fetched at most once per interval, by whichever sensor updates first
+MIN_TIME_BETWEEN_UPDATES = timedelta(minutes=1)
+
+# polling of wallets, while confirmed transactions are received from the feed of the node
+FEED_FALLBACK_INTERVAL = timedelta(minutes=30)
+
+# derived addresses of wallets, persisted between restarts
+ADDRESS_CACHE_FILE = '.iota_addresses.json'
+
+# unused addresses checked after the last used address of a wallet
+LOOK_AHEAD = 3
+
+SERVICE_RESCAN = 'iota_rescan_wallets'
+
 
 def setup_platform(hass, config, add_devices, discovery_info=None):
     """Set up the IOTA sensor."""
     # Add sensors for wallet balance
     iota_config = discovery_info
-    sensors = [IotaBalanceSensor(wallet, iota_config)
-               for wallet in iota_config['wallets']]
+    wallets = IotaWallets(hass, iota_config)
+
+    def rescan_wallets(service):
+        """Derive all addresses of the wallets from scratch on next update."""
+        wallets.rescan = True
+
+    hass.services.register('iota', SERVICE_RESCAN, rescan_wallets)
+    sensors = [IotaBalanceSensor(wallet, iota_config, wallets, index)
+               for index, wallet in enumerate(iota_config['wallets'])]
+
+    # refresh the balance of a wallet as soon as a transaction of one of its addresses is confirmed
+    feed = hass.data.get(DATA_IOTA_FEED)
+    if feed:
+        wallets.feed = feed
+        feed.subscribe(lambda address, transaction_hash: wallets.transaction_confirmed(address, sensors))
 
     # Add sensor for node information
     sensors.append(IotaNodeSensor(iota_config=iota_config))
@@ -32,12 +68,12 @@ def setup_platform(hass, config, add_devices, discovery_info=None):
 class IotaDevice(Entity):
     """Representation of a IOTA device."""
 
-    def __init__(self, name, seed, iri, is_testnet=False):
+    def __init__(self, name, seed, is_testnet=False):
         """Initialisation of the IOTA device."""
         self._name = name
         self._seed = seed
-        self.iri = iri
         self.is_testnet = is_testnet
+        self._api = None
 
     @property
     def name(self):
@@ -52,20 +88,171 @@ class IotaDevice(Entity):
 
     @property
     def api(self):
-        """Construct API object for interaction with the IRI node."""
-        from iota import Iota
-        return Iota(adapter=self.iri, seed=self._seed)
+        """Return API object for interaction with the IRI node."""
+        if self._api is None:
+            self._api = get_api(self.hass, seed=self._seed)
+        return self._api
+
+
+class IotaWallets(object):
+    """Balances of all wallets, which are fetched in parallel.
+
+    Addresses derived from the seeds are cached with their last known balances, so that an update only queries the
+    addresses holding funds and a few addresses following the last used one. All addresses are only derived again
+    from index 0 on a rescan.
+
+    With a feed of the IRI node, a wallet is refreshed as soon as a transaction of one of its addresses has been
+    confirmed (including the balance of that address, even if it is neither funded nor looked ahead), whereas all
+    wallets are only polled every FEED_FALLBACK_INTERVAL as long as the feed is healthy.
+    """
+
+    def __init__(self, hass, iota_config):
+        """Initialize the wallets."""
+        self.hass = hass
+        self.seeds = [wallet['seed'] for wallet in iota_config['wallets']]
+        self.balances = [None] * len(self.seeds)
+        self.rescan = False
+        self.feed = None
+        # wallets with confirmed transactions (index -> confirmed addresses)
+        self.stale = {}
+        self._last_update = None
+        self._lock = Lock()
+        self._apis = None
+        self._path = hass.config.path(ADDRESS_CACHE_FILE)
+        self._caches = [AddressCache() for _ in self.seeds]
+
+        try:
+            with open(self._path) as cache_file:
+                caches = json.load(cache_file)
+            self._caches = [AddressCache(**caches.get(wallet_key(seed), {})) for seed in self.seeds]
+        except (OSError, ValueError, TypeError):
+            _LOGGER.info('No address cache found in %s', self._path)
+
+    @property
+    def apis(self):
+        """Return API objects of all wallets."""
+        if self._apis is None:
+            self._apis = [get_api(self.hass, seed=seed) for seed in self.seeds]
+        return self._apis
+
+    @Throttle(MIN_TIME_BETWEEN_UPDATES)
+    def update(self):
+        """Fetch balances of all wallets from IRI."""
+        if self.feed and self.feed.healthy and not self.rescan and self._last_update is not None and \
+                time.monotonic() - self._last_update < FEED_FALLBACK_INTERVAL.total_seconds():
+            return
+
+        with self._lock:
+            if self.rescan:
+                _LOGGER.info('Rescanning addresses of wallets')
+                self._caches = [AddressCache() for _ in self.seeds]
+                self.rescan = False
+
+            with ThreadPoolExecutor(max_workers=len(self.apis)) as executor:
+                self.balances = list(executor.map(self._fetch_balance, self.apis, self._caches, self.balances))
+            self._last_update = time.monotonic()
+            self.stale.clear()
+            self._save()
+
+    def refresh(self, index):
+        """Fetch the balance of a single wallet from IRI, including the addresses of confirmed transactions."""
+        with self._lock:
+            addresses = self.stale.pop(index, set())
+            self.balances[index] = self._fetch_balance(self.apis[index], self._caches[index], self.balances[index],
+                                                       addresses)
+            self._save()
+
+    def transaction_confirmed(self, address, sensors):
+        """Refresh the sensor of the wallet owning an address."""
+        for index, cache in enumerate(self._caches):
+            if address in cache.addresses:
+                _LOGGER.info('Confirmed transaction of wallet %s', index)
+                self.stale.setdefault(index, set()).add(address)
+                if sensors[index].hass:
+                    sensors[index].schedule_update_ha_state(True)
+
+    @staticmethod
+    def _fetch_balance(api, cache, balance, addresses=()):
+        try:
+            return cache.update(api, addresses)
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception('Error while fetching balance')
+            return balance
+
+    def _save(self):
+        caches = {wallet_key(seed): cache.as_dict() for seed, cache in zip(self.seeds, self._caches)}
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(caches, cache_file)
+        os.replace(tmp_path, self._path)
+
+
+def wallet_key(seed):
+    """Identify the cache of a wallet without storing its seed."""
+    return hashlib.sha256(seed.encode('utf-8')).hexdigest()[:16]
+
+
+class AddressCache(object):
+    """Addresses of a wallet by index with their last known balances."""
+
+    def __init__(self, addresses=None, balances=None, last_used=-1):
+        """Initialize the cache."""
+        self.addresses = addresses or []
+        self.balances = balances or [0] * len(self.addresses)
+        self.last_used = last_used
+
+    def as_dict(self):
+        """Return the cache in a serializable form."""
+        return {'addresses': self.addresses, 'balances': self.balances, 'last_used': self.last_used}
+
+    def update(self, api, addresses=()):
+        """Refresh the balances of funded addresses (and of the given addresses) and return the total balance."""
+        extra = sorted(self.addresses.index(address) for address in set(addresses) if address in self.addresses)
+        while True:
+            # derive missing addresses of the look ahead window
+            window_end = self.last_used + 1 + LOOK_AHEAD
+            if len(self.addresses) < window_end:
+                new_addresses = api.get_new_addresses(index=len(self.addresses),
+                                                      count=window_end - len(self.addresses))['addresses']
+                self.addresses.extend(str(address) for address in new_addresses)
+                self.balances.extend([0] * len(new_addresses))
+
+            # funded addresses and the look ahead window
+            indices = [i for i, balance in enumerate(self.balances[:self.last_used + 1]) if balance]
+            indices.extend(range(self.last_used + 1, window_end))
+            indices.extend(i for i in extra if i not in indices)
+            balances = api.get_balances(addresses=[self.addresses[i] for i in indices])['balances']
+            for index, balance in zip(indices, balances):
+                self.balances[index] = int(balance)
+
+            # continue with the next window, if an address of the window has been used
+            used = self._used_in_window(api, window_end)
+            if used is None:
+                return sum(self.balances)
+            self.last_used = used
+
+    def _used_in_window(self, api, window_end):
+        """Return the highest index of the window, whose address has transactions."""
+        window = list(range(self.last_used + 1, window_end))
+        funded = [i for i in window if self.balances[i]]
+        if not api.find_transactions(addresses=[self.addresses[i] for i in window])['hashes']:
+            return max(funded) if funded else None
+        for index in reversed(window):
+            if self.balances[index] or api.find_transactions(addresses=[self.addresses[index]])['hashes']:
+                return index
+        return None
 
 
 class IotaBalanceSensor(IotaDevice):
     """Implement an IOTA sensor for displaying wallets balance."""
 
-    def __init__(self, wallet_config, iota_config):
+    def __init__(self, wallet_config, iota_config, wallets, index):
         """Initialize the sensor."""
         super().__init__(name=wallet_config['name'],
                          seed=wallet_config['seed'],
-                         iri=iota_config['iri'],
                          is_testnet=iota_config['testnet'])
+        self._wallets = wallets
+        self._index = index
         self._state = None
 
     @property
@@ -84,8 +271,12 @@ class IotaBalanceSensor(IotaDevice):
         return 'IOTA'
 
     def update(self):
-        """Fetch new balance from IRI."""
-        self._state = self.api.get_inputs()['totalBalance']
+        """Fetch new balance from IRI, together with all other wallets."""
+        if self._index in self._wallets.stale:
+            self._wallets.refresh(self._index)
+        else:
+            self._wallets.update()
+        self._state = self._wallets.balances[self._index]
 
 
 class IotaNodeSensor(IotaDevice):
@@ -93,10 +284,9 @@ class IotaNodeSensor(IotaDevice):
 
     def __init__(self, iota_config):
         """Initialize the sensor."""
-        super().__init__(name='Node Info', seed=None, iri=iota_config['iri'],
-                         is_testnet=iota_config['testnet'])
+        super().__init__(name='Node Info', seed=None, is_testnet=iota_config['testnet'])
         self._state = None
-        self._attr = {'url': self.iri, 'testnet': self.is_testnet}
+        self._attr = {'testnet': self.is_testnet}
 
     @property
     def name(self):
@@ -114,9 +304,13 @@ class IotaNodeSensor(IotaDevice):
         return self._attr
 
     def update(self):
-        """Fetch new attributes IRI node."""
-        node_info = self.api.get_node_info()
+        """Check the health of all IRI nodes and show the attributes of the best one."""
+        pool = self.hass.data[DATA_IOTA]
+        pool.check_nodes()
+        node = pool.best()
+        node_info = node.info or {}
         self._state = node_info.get('appVersion')
 
         # convert values to raw string formats
         self._attr.update({k: str(v) for k, v in node_info.items()})
+        self._attr.update({'url': node.url, 'nodes': pool.status()})
@@ -0,0 +1,74 @@
+"""Replays a recorded feed of an IRI node, standing in for the node when testing feed subscribers.
+
+Messages (e.g. 'sn <milestone> <hash> <address> <trunk> <branch> <bundle>') are read line by line from files and
+published via ZMQ (tcp://*:5556, requires pyzmq) or MQTT (mqtt://<host>:1883, topic is the first word). Confirmed
+transactions of addresses can be generated instead of recorded, e.g.
+
+    python feed_replayer.py --url mqtt://localhost:1883 --address <address>
+"""
+import argparse
+import random
+import string
+import time
+from urllib.parse import urlsplit
+
+
+def random_trytes(length=81):
+    return ''.join(random.choice(string.ascii_uppercase + '9') for _ in range(length))
+
+
+def confirmed_transaction(address, milestone=1):
+    return 'sn {} {} {} {} {} {}'.format(milestone, random_trytes(), address, random_trytes(), random_trytes(),
+                                         random_trytes())
+
+
+def zmq_publisher(url):
+    import zmq
+    socket = zmq.Context.instance().socket(zmq.PUB)
+    socket.bind(url)
+    return socket.send_string
+
+
+def mqtt_publisher(url):
+    import paho.mqtt.client as mqtt
+    url = urlsplit(url)
+    client = mqtt.Client()
+    client.connect(url.hostname, url.port or 1883)
+    client.loop_start()
+
+    def publish(message):
+        topic, _, payload = message.partition(' ')
+        client.publish(topic, payload).wait_for_publish()
+    return publish
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='*', help='files with one message per line')
+    parser.add_argument('--url', default='tcp://*:5556', help='ZMQ address to bind or MQTT broker to publish to')
+    parser.add_argument('--address', action='append', default=[], help='address with a confirmed transaction')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between messages')
+    parser.add_argument('--delay', type=float, default=1.0, help='seconds before the first message')
+    parser.add_argument('--loop', action='store_true', help='replay messages forever')
+    args = parser.parse_args()
+
+    messages = [confirmed_transaction(address) for address in args.address]
+    for path in args.files:
+        with open(path) as feed:
+            messages.extend(line.strip() for line in feed if line.strip())
+
+    publish = mqtt_publisher(args.url) if urlsplit(args.url).scheme == 'mqtt' else zmq_publisher(args.url)
+
+    # subscribers of ZMQ miss messages published before they are connected
+    time.sleep(args.delay)
+    while True:
+        for message in messages:
+            print(message[:80])
+            publish(message)
+            time.sleep(args.interval)
+        if not args.loop:
+            break
+
+
+if __name__ == '__main__':
+    main()
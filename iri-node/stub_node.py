@@ -0,0 +1,117 @@
+"""Stub of an IRI node answering the API calls of the IOTA wallets in Home Assistant, for testing pools of nodes.
+
+Each node answers getNodeInfo with its milestones, getBalances with zero balances and findTransactions without
+hashes. Nodes can be slow, lag behind the latest milestone or fail a share of requests, e.g. a fast node, a
+slow node and a node lagging 10 milestones behind and failing half of the requests
+
+    python stub_node.py --node 14265 --node 14266:0.5 --node 14267:0:10:0.5
+"""
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubNode:
+    """In-process stand-in for an IRI node, which delays each response by latency seconds, lags lag milestones
+    behind the latest milestone and fails a share of failures requests with status 500."""
+
+    def __init__(self, latency=0.0, lag=0, failures=0.0, milestone=1000, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.lag = lag
+        self.failures = failures
+        self.milestone = milestone
+        self.calls = {}
+
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length).decode('utf-8') or '{}') if length else {}
+                status, response = node.handle(request)
+                payload = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def handle(self, request):
+        command = request.get('command')
+        self.calls[command] = self.calls.get(command, 0) + 1
+        time.sleep(self.latency)
+        if random.random() < self.failures:
+            return 500, {'error': 'Stub node failed'}
+
+        if command == 'getNodeInfo':
+            milestone = self.milestone - self.lag
+            return 200, {'appName': 'IRI Stub', 'appVersion': '1.4.1.6', 'latestMilestoneIndex': milestone,
+                         'latestSolidSubtangleMilestoneIndex': milestone, 'neighbors': 0, 'tips': 0,
+                         'time': int(time.time() * 1000), 'duration': 0}
+        if command == 'getBalances':
+            return 200, {'balances': ['0'] * len(request.get('addresses', [])), 'milestone': '9' * 81,
+                         'milestoneIndex': self.milestone - self.lag, 'duration': 0}
+        if command == 'findTransactions':
+            return 200, {'hashes': [], 'duration': 0}
+        return 400, {'error': 'Command {} not supported by stub node'.format(command)}
+
+
+def parse_node(spec):
+    """Parses PORT[:LATENCY[:LAG[:FAILURES]]] of a node."""
+    values = spec.split(':')
+    return {'port': int(values[0]),
+            'latency': float(values[1]) if len(values) > 1 else 0.0,
+            'lag': int(values[2]) if len(values) > 2 else 0,
+            'failures': float(values[3]) if len(values) > 3 else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--node', type=parse_node, action='append', default=[],
+                        help='node as PORT[:LATENCY[:LAG[:FAILURES]]]')
+    parser.add_argument('--host', default='0.0.0.0', help='address nodes listen on')
+    args = parser.parse_args()
+
+    nodes = [StubNode(host=args.host, **node).start() for node in args.node or [parse_node('14265')]]
+    for node in nodes:
+        print('Stub node on {} (latency {}s, lag {}, failures {})'.format(node.url, node.latency, node.lag,
+                                                                         node.failures))
+
+    # nodes in sync follow a new milestone every minute
+    while True:
+        time.sleep(60)
+        for node in nodes:
+            node.milestone += 1
+
+
+if __name__ == '__main__':
+    main()